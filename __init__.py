@@ -4,6 +4,7 @@ from bpy.props import (StringProperty,
                        BoolProperty,
                        IntProperty,
                        FloatProperty,
+                       EnumProperty,
                        PointerProperty,
                        )
 from bpy.types import (Panel,
@@ -139,6 +140,36 @@ class SDProperties(PropertyGroup):
         default=True
     )
 
+    batch_views: BoolProperty(
+        name="Batch views",
+        description="Render all views first and generate them together in batched pipeline calls.\n"
+                    "Faster on the GPU, but views do not see the texture generated by the previous ones",
+        default=False
+    )
+
+    pipeline_views: BoolProperty(
+        name="Pipeline views",
+        description="Render and upload the next view while the server generates the current one.\n"
+                    "Faster, but every view sees the texture generated up to the view before the previous one",
+        default=False
+    )
+
+    server_render: BoolProperty(
+        name="Render on the server",
+        description="Send the mesh once and let the server render the UV, depth and alpha of every view.\n"
+                    "Blender does not render the views and all of them are queued at once",
+        default=False
+    )
+
+    max_batch_size: IntProperty(
+        name="Max batch size",
+        description="Maximum number of views generated in a single pipeline call. "
+                    "Batches are split further if they do not fit in GPU memory",
+        default=4,
+        min=1,
+        max=16
+    )
+
     clear_txt: BoolProperty(
         name="Start with empty texture",
         description="If enabled, the output texture will be cleared before generation.\n"
@@ -147,6 +178,26 @@ class SDProperties(PropertyGroup):
         default=True
     )
 
+    projection: EnumProperty(
+        name="Projection",
+        description="How generated views are projected onto the texture",
+        items=[('forward', "Forward", "Every pixel of a 2x upscaled view is written to its texel"),
+               ('inverse', "Inverse", "Every texel samples the view at its position on the screen. "
+                                      "No gaps, but building the texel index of a new view is much slower "
+                                      "and uses more memory, especially for large textures"),
+               ],
+        default='forward'
+    )
+
+    texture_size: IntProperty(
+        name="Texture size",
+        description="Width and height of a new output texture. Textures above 2048 are kept in files "
+                    "on the server and only a preview of them is shown until the generation finishes",
+        default=768,
+        min=256,
+        max=8192
+    )
+
     resolution_x: IntProperty(
         name="Resolution X",
         description="Resolution X",
@@ -240,9 +291,15 @@ class OBJECT_PT_SDPanel(Panel):
         sd_tool = scene.sd_txt_tool
 
         layout.prop(sd_tool, "depth_based_blending")
+        layout.prop(sd_tool, "batch_views")
+        layout.prop(sd_tool, "pipeline_views")
+        layout.prop(sd_tool, "server_render")
+        layout.prop(sd_tool, "max_batch_size")
         layout.prop(sd_tool, "num_inference_steps")
         layout.prop(sd_tool, "guidance_scale")
         layout.prop(sd_tool, "seed")
+        layout.prop(sd_tool, "projection")
+        layout.prop(sd_tool, "texture_size")
         layout.prop(sd_tool, "resolution_x")
         layout.prop(sd_tool, "resolution_y")
 
@@ -0,0 +1,256 @@
+import argparse
+import importlib
+import json
+import pathlib
+import sys
+import time
+import types
+
+import bpy
+
+# Headless texturing of many assets, run by Blender in background mode against a running SD server:
+#   blender -b --python batch_texture.py -- manifest.json --port 5000 --in-flight 2 --report report.json
+# The manifest lists the assets, "defaults" apply to all of them and take the names of the add-on settings:
+#   {"defaults": {"num_inference_steps": 30, "views_num": 4, "texture_size": 2048, "negative_prompt": "blurry"},
+#    "assets": [{"blend": "chair.blend", "target": "Chair", "prompt": "An oak chair", "seed": 7,
+#                "out_txt": "/textures/chair.png"}]}
+# Every asset is opened and its views go to its own texture session the way the add-on sends them. By default
+# each view is rendered with the texture generated by the previous ones and waited for. pipeline_views renders
+# the next view while the server generates the current one. batch_views and server_render send all views at
+# once, then the next assets are rendered while the server generates them, with up to --in-flight assets
+# submitted at a time. Relative paths in the manifest are relative to the manifest file.
+
+# The add-on modules import each other relatively. They are loaded as a package from the files next to this
+# script, whatever its directory is called (e.g. SDTG4B-main), and without registering the add-on.
+ADDON_DIR = pathlib.Path(__file__).resolve().parent
+ADDON_PACKAGE = "sdtg4b_batch"
+sys.modules[ADDON_PACKAGE] = types.ModuleType(ADDON_PACKAGE)
+sys.modules[ADDON_PACKAGE].__path__ = [str(ADDON_DIR)]
+operators = importlib.import_module(F"{ADDON_PACKAGE}.operators")
+sd_client = importlib.import_module(F"{ADDON_PACKAGE}.sd_client")
+
+DEFAULTS = {
+    "negative_prompt": "",
+    "num_inference_steps": 30,
+    "guidance_scale": 7.5,
+    "seed": 1234567,
+    "views_num": 4,
+    "camera_r": 6.0,
+    "camera_z": 2.0,
+    "resolution_x": 768,
+    "resolution_y": 512,
+    "texture_size": 768,
+    "projection": "forward",
+    "depth_based_blending": True,
+    "batch_views": False,
+    "pipeline_views": False,
+    "max_batch_size": 4,
+    "clear_txt": True,
+    "server_render": False,
+}
+# Settings of a single asset besides the DEFAULTS, "prompt" can also be given in "defaults"
+ASSET_KEYS = {"blend", "target", "prompt", "name", "out_dir", "out_txt"}
+
+
+class Asset:
+    def __init__(self, settings, base_dir):
+        self.settings = settings
+        self.blend = base_dir / settings["blend"]
+        self.target = settings["target"]
+        self.name = settings.get("name") or F"{self.blend.stem}/{self.target}"
+        out_dir = base_dir / settings["out_dir"] if settings.get("out_dir") else \
+            self.blend.parent / F"sdtg4b_{self.blend.stem}_{self.target}"
+        self.tmp_path = out_dir / "tmp"
+        self.result_path = out_dir / "result"
+        self.txt_path = base_dir / settings["out_txt"] if settings.get("out_txt") else self.result_path / "txt.png"
+        self.session_id = None
+        self.job_ids = []
+        self.jobs = []
+        self.error = None
+        # Seconds spent in every local stage, the server stages come from the finished jobs
+        self.timings = dict()
+        self.started_at = None
+        self.finished_at = None
+        # End of the last timed stage
+        self.mark = None
+
+    def stage(self, name):
+        now = time.time()
+        self.timings[name] = self.timings.get(name, 0.0) + now - self.mark
+        self.mark = now
+
+    def step_data(self):
+        return {
+            "prompt": self.settings["prompt"],
+            "n_prompt": self.settings["negative_prompt"],
+            "out_txt": str(self.txt_path),
+            "session_id": self.session_id,
+            "depth_based_mixing": self.settings["depth_based_blending"],
+            "steps": self.settings["num_inference_steps"],
+            "guidance_scale": self.settings["guidance_scale"],
+            "seed": self.settings["seed"],
+            "projection": self.settings["projection"],
+        }
+
+    def to_dict(self):
+        server_stages = dict()
+        for job in self.jobs:
+            for name, stage_time in job["stages"].items():
+                server_stages[name] = server_stages.get(name, 0.0) + stage_time
+        return {
+            "asset": self.name,
+            "blend": str(self.blend),
+            "target": self.target,
+            "out_txt": str(self.txt_path),
+            "state": "error" if self.error else "done",
+            "error": self.error,
+            "total_time": (self.finished_at or time.time()) - self.started_at,
+            "local_stages": self.timings,
+            "server_wait_time": sum(job["wait_time"] for job in self.jobs),
+            "server_run_time": sum(job["run_time"] for job in self.jobs),
+            "server_stages": server_stages,
+        }
+
+
+def wait_for_job(client, asset, job_id):
+    asset.jobs.append(operators.check_job(operators.wait_for_job(client, job_id)))
+
+
+def submit_asset(client, asset):
+    asset.started_at = asset.mark = time.time()
+    bpy.ops.wm.open_mainfile(filepath=str(asset.blend))
+    target = bpy.data.objects[asset.target]
+    asset.stage("open")
+
+    settings = asset.settings
+    asset.tmp_path.mkdir(parents=True, exist_ok=True)
+    asset.result_path.mkdir(parents=True, exist_ok=True)
+    image_name = operators.setup_scene(target, asset.tmp_path, str(asset.txt_path), settings["clear_txt"],
+                                       settings["texture_size"])
+    camera = operators.add_camera(target)
+    scene_key = operators.scene_key(target, camera, settings["resolution_x"], settings["resolution_y"])
+    frame_code = "{0:0>4}".format(bpy.context.scene.frame_current)
+    plan = operators.camera_plan(settings["views_num"], settings["camera_r"], settings["camera_z"])
+    asset.stage("setup")
+
+    mesh = None
+    camera_settings = None
+    if settings["server_render"]:
+        # The server renders the views from the mesh, Blender only sends it once
+        mesh = operators.mesh_arrays(target)
+        camera_settings = operators.server_camera(camera, target, settings["resolution_x"], settings["resolution_y"])
+        asset.stage("render")
+
+    def render(num, camera_location):
+        asset.stage("upload")
+        passes = operators.render_passes(camera_location, settings["resolution_x"], settings["resolution_y"],
+                                         asset.tmp_path, frame_code)
+        asset.stage("render")
+        return passes, operators.view_key(scene_key, camera_location)
+
+    def wait(num, job_id):
+        asset.stage("upload")
+        wait_for_job(client, asset, job_id)
+        texture = client.texture(asset.session_id, max_size=operators.PREVIEW_SIZE)
+        operators.set_image_pixels(bpy.data.images[image_name], texture)
+        asset.stage("generate")
+        return job_id
+
+    # Views rendered in Blender see the texture generated so far. Batches and views rendered on the server are
+    # all submitted at once, their jobs and the ones of the last views are waited for with the finishing step.
+    asset.session_id = client.create_session({"out_txt": str(asset.txt_path),
+                                              "texture_size": settings["texture_size"]})
+    operators.submit_plan(client, asset.step_data(), plan, asset.job_ids, render, wait,
+                          batch_views=settings["batch_views"], pipeline_views=settings["pipeline_views"],
+                          max_batch_size=settings["max_batch_size"], mesh=mesh, server_camera=camera_settings)
+    # Jobs of a session run in order, the texture is finished right after its views
+    asset.job_ids.append(client.submit_job("/session/finish", {"session_id": asset.session_id}))
+    asset.stage("upload")
+
+
+def asset_failed(client, asset, error):
+    asset.error = F"{type(error).__name__}: {error}"
+    if asset.session_id is not None:
+        # The texture was not finished, its session would stay on the server
+        try:
+            client.discard_session(asset.session_id)
+        except (RuntimeError, OSError):
+            pass
+    asset.finished_at = time.time()
+    print(F"{asset.name} failed: {asset.error}")
+
+
+def wait_for_asset(client, asset):
+    try:
+        # Jobs waited for while the views were submitted are already in asset.jobs
+        for job_id in asset.job_ids[len(asset.jobs):]:
+            wait_for_job(client, asset, job_id)
+    except (RuntimeError, OSError) as e:
+        asset_failed(client, asset, e)
+        return
+    asset.finished_at = time.time()
+
+
+def print_report(report, wall_time):
+    print(F"\n{'asset':<40}{'state':>7}{'total s':>10}{'render s':>10}{'queue s':>10}{'diffusion s':>13}")
+    for entry in report:
+        print(F"{entry['asset'][:39]:<40}{entry['state']:>7}{entry['total_time']:>10.1f}"
+              F"{entry['local_stages'].get('render', 0.0):>10.1f}{entry['server_wait_time']:>10.1f}"
+              F"{entry['server_stages'].get('diffusion', 0.0):>13.1f}")
+    done = sum(entry["state"] == "done" for entry in report)
+    print(F"{done} of {len(report)} assets textured in {wall_time:.1f}s")
+
+
+def main():
+    argv = sys.argv[sys.argv.index("--") + 1:] if "--" in sys.argv else []
+    parser = argparse.ArgumentParser(prog="blender -b --python batch_texture.py --",
+                                     description="Textures the assets of a manifest with a running SD server")
+    parser.add_argument("manifest", help="JSON file with the assets and their settings")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=5000)
+    parser.add_argument("--in-flight", type=int, default=2,
+                        help="Assets submitted to the server at a time, the next ones are rendered meanwhile")
+    parser.add_argument("--report", help="JSON file with the timings of every asset, next to the manifest by default")
+    args = parser.parse_args(argv)
+
+    manifest_path = pathlib.Path(args.manifest).resolve()
+    with open(manifest_path) as f:
+        manifest = json.load(f)
+    # A misspelled setting would silently fall back to its default
+    for settings in [manifest.get("defaults", {})] + manifest["assets"]:
+        unknown = sorted(set(settings) - set(DEFAULTS) - ASSET_KEYS)
+        if unknown:
+            sys.exit(F"Unknown settings in {manifest_path}: {', '.join(unknown)}")
+    defaults = dict(DEFAULTS, **manifest.get("defaults", {}))
+    assets = [dict(defaults, **settings) for settings in manifest["assets"]]
+    report_path = pathlib.Path(args.report) if args.report else manifest_path.with_suffix(".report.json")
+
+    client = sd_client.SDClient(F"http://{args.host}:{args.port}")
+    status = client.status()
+    if status["state"] == "error":
+        sys.exit(F"The SD server could not load the model: {status['error']}")
+
+    started_at = time.time()
+    assets = [Asset(settings, manifest_path.parent) for settings in assets]
+    in_flight = []
+    for asset in assets:
+        print(F"Submitting {asset.name}")
+        try:
+            submit_asset(client, asset)
+            in_flight.append(asset)
+        except (KeyError, RuntimeError, OSError) as e:
+            asset_failed(client, asset, e)
+        while len(in_flight) >= max(args.in_flight, 1):
+            wait_for_asset(client, in_flight.pop(0))
+    for asset in in_flight:
+        wait_for_asset(client, asset)
+
+    report = [asset.to_dict() for asset in assets]
+    with open(report_path, "w") as f:
+        json.dump(report, f, indent=2)
+    print_report(report, time.time() - started_at)
+    print(F"Report written to {report_path}")
+
+
+if __name__ == "__main__":
+    main()
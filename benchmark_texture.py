@@ -0,0 +1,370 @@
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+
+try:
+    import resource
+except ImportError:
+    # No getrusage on Windows, memory is not reported there
+    resource = None
+
+# Has to be set before OpenCV reads the first EXR file
+os.environ["OPENCV_IO_ENABLE_OPENEXR"] = "1"
+
+import cv2
+import numpy as np
+from PIL import Image
+
+from start_sd_server import (TextureSession, build_inverse_view_index, build_view_index, finish_texture, load_passes,
+                             prepare_view, project_view, scatter_view, upscale_view)
+
+# Benchmark of the texture side of start_sd_server.py on synthetic render passes, no GPU or model needed:
+#   python benchmark_texture.py --sizes 512 1024 --texture-sizes 768 2048 --views 3
+# --large adds 2048 and 4096 renders and 4096 textures, which need several GB of memory and minutes per run.
+# Every render and texture size runs in a fresh process. Every stage reports its wall time, the peak RSS of the
+# process after it and how much the stage raised that peak (getrusage, so OpenCV and PIL buffers count too).
+# A stage that stays below the peak of the stages before it shows no growth. Before the timings, the vectorized
+# texture functions and the session path (view indexes, weighted accumulation and resolve) are compared against
+# per-texel loops on small fixtures and the script fails if any output differs.
+
+
+# ------------------------------------------------------------------------
+#    Reference implementations (original per-texel loops)
+# ------------------------------------------------------------------------
+
+def reference_finish_texture(out_img_arr, partial=False):
+    for neighbours in (lambda x, y: [[x, y - 1], [x, y + 1]], lambda x, y: [[x - 1, y], [x + 1, y]]):
+        for x in range(out_img_arr.shape[0]):
+            for y in range(out_img_arr.shape[1]):
+                color = out_img_arr[x][y]
+                if sum(color) < 0.00001:
+                    number_of_colors = 0
+                    out_color = np.array([0, 0, 0])
+                    for x1, y1 in neighbours(x, y):
+                        if x1 >= out_img_arr.shape[0] or y1 >= out_img_arr.shape[1]:
+                            continue
+                        c = out_img_arr[x1][y1]
+                        if sum(c) > 0.00001:
+                            out_color += c
+                            number_of_colors += 1
+                    if number_of_colors == 0 or (partial and number_of_colors < 2):
+                        continue
+                    out_color = out_color / float(number_of_colors)
+                    out_img_arr[x, y] = out_color
+    return out_img_arr
+
+
+def reference_project_view(out_img_arr, img_arr, uv_img_arr, src_alpha_arr, depth_arr, depth_based_mixing=False):
+    wip_out_img_arr = out_img_arr.copy()
+    for x in range(uv_img_arr.shape[0]):
+        for y in range(uv_img_arr.shape[1]):
+            u, v, w = uv_img_arr[x][y]
+            a = src_alpha_arr[x][y]
+            try:
+                if a > 244 and sum([u, v, w]) > 0.00000001:
+                    u2 = int(out_img_arr.shape[1] - 1) - int(out_img_arr.shape[1] * v) - 1
+                    v2 = int(out_img_arr.shape[0] * u) - 1
+
+                    if depth_based_mixing and sum(out_img_arr[u2, v2]) > 0:
+                        depth = (np.clip(depth_arr[x][y][0] / 255, 0, 0.5) * 2) ** 2
+                        wip_out_img_arr[u2, v2] = img_arr[x][y] * (1 - depth) + out_img_arr[u2, v2] * depth
+                    else:
+                        wip_out_img_arr[u2, v2] = img_arr[x][y]
+            except IndexError:
+                pass
+    for x in range(out_img_arr.shape[0]):
+        for y in range(out_img_arr.shape[1]):
+            if depth_based_mixing:
+                out_img_arr[x, y] = wip_out_img_arr[x][y]
+            elif sum(out_img_arr[x, y]) == 0:
+                out_img_arr[x, y] = wip_out_img_arr[x][y]
+    return out_img_arr
+
+
+def reference_forward_samples(tex_shape, img_arr, uv_img_arr, src_alpha_arr, depth_arr):
+    # Every covered pixel in row-major order with the texel it lands in, like the loop of reference_project_view
+    samples = []
+    for x in range(uv_img_arr.shape[0]):
+        for y in range(uv_img_arr.shape[1]):
+            u, v, w = uv_img_arr[x][y]
+            if src_alpha_arr[x][y] > 244 and sum([u, v, w]) > 0.00000001:
+                u2 = int(tex_shape[1] - 1) - int(tex_shape[1] * v) - 1
+                v2 = int(tex_shape[0] * u) - 1
+                if -tex_shape[0] <= u2 < tex_shape[0] and -tex_shape[1] <= v2 < tex_shape[1]:
+                    depth = np.float32((np.clip(depth_arr[x][y] / 255, 0, 0.5) * 2) ** 2)
+                    samples.append((u2 % tex_shape[0], v2 % tex_shape[1], img_arr[x][y][:3].astype(np.float32),
+                                    depth))
+    return samples
+
+
+def reference_inverse_samples(tex_shape, img_arr, depth_arr, index):
+    # Bilinear samples of the inverse index, one entry at a time
+    samples = []
+    for entry in index:
+        color = np.zeros(3, dtype=np.float32)
+        depth = np.float32(0)
+        for src, weight in zip(entry["src"], entry["weight"]):
+            x, y = divmod(int(src), img_arr.shape[1])
+            color += weight * img_arr[x][y][:3].astype(np.float32)
+            depth += weight * np.float32(depth_arr[x][y])
+        depth = np.float32((np.clip(depth / 255, 0, 0.5) * 2) ** 2)
+        samples.append((int(entry["texel"]) // tex_shape[1], int(entry["texel"]) % tex_shape[1], color, depth))
+    return samples
+
+
+def reference_accumulate(texture, views, depth_based_mixing, partial=False):
+    # Weighted average of the starting texture and the samples of every view, resolved like TextureSession
+    weight = np.zeros(texture.shape[:2], dtype=np.float32)
+    color = np.zeros(texture.shape[:2] + (3,), dtype=np.float32)
+    for x in range(texture.shape[0]):
+        for y in range(texture.shape[1]):
+            if sum(texture[x][y]) > 0:
+                weight[x, y] = TextureSession.prior_weight
+                color[x, y] = texture[x][y].astype(np.float32) * weight[x, y]
+
+    for samples in views:
+        # The samples of a view are summed before they are added, texels are free if no earlier view covered them
+        view_weight = dict()
+        view_color = dict()
+        for row, col, sample_color, depth in samples:
+            if depth_based_mixing:
+                sample_weight = max(1 - float(depth), TextureSession.min_sample_weight)
+            elif weight[row, col] == 0:
+                sample_weight = 1.0
+            else:
+                continue
+            view_weight[row, col] = view_weight.get((row, col), 0.0) + sample_weight
+            for channel in range(3):
+                key = (row, col, channel)
+                view_color[key] = view_color.get(key, 0.0) + sample_weight * float(sample_color[channel])
+        for (row, col), sample_weight in view_weight.items():
+            weight[row, col] += sample_weight
+            for channel in range(3):
+                color[row, col, channel] += view_color[row, col, channel]
+
+    out_img_arr = np.zeros(texture.shape[:2] + (3,), dtype=np.uint8)
+    for x in range(texture.shape[0]):
+        for y in range(texture.shape[1]):
+            out_img_arr[x, y] = np.clip(np.rint(color[x, y] / max(weight[x, y], np.float32(0.000001))), 0, 255)
+    return reference_finish_texture(out_img_arr, partial)
+
+
+# ------------------------------------------------------------------------
+#    Fixtures
+# ------------------------------------------------------------------------
+
+def sparse_texture(rng, size, coverage=0.5):
+    texture = rng.integers(1, 256, (size, size, 3), dtype=np.uint8)
+    texture[rng.random((size, size)) > coverage] = 0
+    return texture
+
+
+def synthetic_passes(size, seed=0, angle=0.0):
+    # A sphere seen from the front: UVs are its longitude and latitude, depth grows towards the silhouette
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[-1:1:size * 1j, -1:1:size * 1j].astype(np.float32)
+    radius = np.sqrt(x ** 2 + y ** 2)
+    inside = radius < 0.95
+    z = np.sqrt(np.clip(1 - radius ** 2, 0, 1))
+
+    uv = np.zeros((size, size, 3), dtype=np.float32)
+    uv[..., 0] = (np.arctan2(x, z) / (2 * np.pi) + 0.5 + angle) % 1.0
+    uv[..., 1] = np.arcsin(np.clip(y, -1, 1)) / np.pi + 0.5
+    uv[~inside] = 0
+
+    depth = np.where(inside, (1 - z) * 255, 0).astype(np.uint8)
+    alpha = np.where(inside, 255, 0).astype(np.uint8)
+    diffuse = rng.integers(0, 256, (size, size, 3), dtype=np.uint8)
+    diffuse[~inside] = 0
+    return {"depth": depth, "uv": uv, "alpha": alpha, "diffuse": diffuse}
+
+
+def write_passes(passes, directory):
+    paths = {
+        "depth": os.path.join(directory, "depth.bmp"),
+        "uv": os.path.join(directory, "uv.exr"),
+        "alpha": os.path.join(directory, "alpha.png"),
+        "diffuse": os.path.join(directory, "diffuse.bmp"),
+    }
+    Image.fromarray(passes["depth"]).save(paths["depth"])
+    cv2.imwrite(paths["uv"], cv2.cvtColor(passes["uv"], cv2.COLOR_RGB2BGR))
+    Image.fromarray(passes["alpha"]).save(paths["alpha"])
+    Image.fromarray(passes["diffuse"]).save(paths["diffuse"])
+    return paths
+
+
+# ------------------------------------------------------------------------
+#    Benchmark
+# ------------------------------------------------------------------------
+
+def peak_rss_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return peak / 2 ** 20 if sys.platform == "darwin" else peak / 2 ** 10
+
+
+def measure(results, stage, function, *args):
+    peak_before = peak_rss_mb()
+    started_at = time.perf_counter()
+    value = function(*args)
+    wall_time = time.perf_counter() - started_at
+    peak_after = peak_rss_mb()
+
+    entry = results.setdefault(stage, {"time": 0.0, "peak_rss_mb": None, "rss_growth_mb": None, "calls": 0})
+    entry["time"] += wall_time
+    if peak_after is not None:
+        entry["peak_rss_mb"] = peak_after
+        entry["rss_growth_mb"] = max(entry["rss_growth_mb"] or 0.0, peak_after - peak_before)
+    entry["calls"] += 1
+    return value
+
+
+def check_identity(size, trials):
+    rng = np.random.default_rng(1024)
+    mismatches = []
+    for trial in range(trials):
+        texture = sparse_texture(rng, size, coverage=rng.random())
+        for partial in (False, True):
+            expected = reference_finish_texture(texture.copy(), partial)
+            if not np.array_equal(finish_texture(texture.copy(), partial), expected):
+                mismatches.append(F"finish_texture partial={partial} trial={trial}")
+
+        passes = synthetic_passes(size, seed=trial, angle=rng.random())
+        img_arr = rng.integers(0, 256, (size, size, 3), dtype=np.uint8)
+        depth_arr = np.repeat(passes["depth"][..., np.newaxis], 3, axis=-1)
+        for depth_based_mixing in (False, True):
+            args = (img_arr, passes["uv"], passes["alpha"], depth_arr, depth_based_mixing)
+            expected = reference_project_view(texture.copy(), *args)
+            if not np.array_equal(project_view(texture.copy(), *args), expected):
+                mismatches.append(F"project_view depth_based_mixing={depth_based_mixing} trial={trial}")
+
+        # Session path: two views of the sphere accumulated over the starting texture
+        views = []
+        for view_num in range(2):
+            passes = synthetic_passes(size, seed=trial * 2 + view_num, angle=rng.random())
+            img_arr = rng.integers(0, 256, (size, size, 3), dtype=np.uint8)
+            views.append((img_arr, passes))
+        for projection in ("forward", "inverse"):
+            indexes = []
+            reference_views = []
+            for img_arr, passes in views:
+                if projection == "forward":
+                    index = build_view_index(texture.shape, passes["uv"], passes["alpha"], passes["depth"])
+                    reference_views.append(reference_forward_samples(texture.shape, img_arr, passes["uv"],
+                                                                     passes["alpha"], passes["depth"]))
+                else:
+                    index = build_inverse_view_index(texture.shape, passes["uv"], passes["alpha"], passes["depth"])
+                    reference_views.append(reference_inverse_samples(texture.shape, img_arr, passes["depth"], index))
+                    # The drawn texels cover at least the texels the covered pixels land in
+                    forward = {(row, col) for row, col, _, _ in reference_forward_samples(
+                        texture.shape, img_arr, passes["uv"], passes["alpha"], passes["depth"])}
+                    drawn = [(int(texel) // texture.shape[1], int(texel) % texture.shape[1])
+                             for texel in index["texel"]]
+                    if not forward <= set(drawn) or not np.allclose(index["weight"].sum(axis=-1), 1, atol=1e-5):
+                        mismatches.append(F"build_inverse_view_index coverage trial={trial}")
+                indexes.append(index)
+
+            for depth_based_mixing in (False, True):
+                session = TextureSession("check.png", texture.shape)
+                for rows in session.bands():
+                    session.set_texture(rows, texture[rows])
+                for (img_arr, _), index in zip(views, indexes):
+                    session.add_samples(img_arr, index, depth_based_mixing)
+                for partial in (False, True):
+                    expected = reference_accumulate(texture, reference_views, depth_based_mixing, partial)
+                    if not np.array_equal(session.resolve(partial), expected):
+                        mismatches.append(F"TextureSession {projection} depth_based_mixing={depth_based_mixing} "
+                                          F"partial={partial} trial={trial}")
+                session.close()
+    return mismatches
+
+
+def benchmark(render_size, texture_size, views, depth_based_mixing):
+    results = dict()
+    rng = np.random.default_rng(render_size + texture_size)
+    session = TextureSession("benchmark.png", (texture_size, texture_size))
+    legacy_texture = np.zeros((texture_size, texture_size, 3), dtype=np.uint8)
+
+    with tempfile.TemporaryDirectory() as directory:
+        for view_num in range(views):
+            paths = write_passes(synthetic_passes(render_size, seed=view_num, angle=view_num / views), directory)
+            passes = measure(results, "decode", load_passes, paths)
+            view_input = measure(results, "prepare", prepare_view, {}, passes)
+            # Stands in for the generated image, it has the size of the render like the model output
+            img = Image.fromarray(rng.integers(0, 256, (render_size, render_size, 3), dtype=np.uint8))
+            img_arr, uv_img_arr, alpha_arr, depth_arr = measure(results, "upscale", upscale_view, passes, img)
+            measure(results, "scatter", scatter_view, session.weight.shape, uv_img_arr, alpha_arr)
+            measure(results, "accumulate", session.add_view, img_arr, uv_img_arr, alpha_arr, depth_arr,
+                    depth_based_mixing)
+            inverse_index = measure(results, "inverse index", build_inverse_view_index, session.weight.shape,
+                                    passes["uv"], passes["alpha"], passes["depth"])
+            measure(results, "inverse accumulate", session.add_samples, np.asarray(img), inverse_index,
+                    depth_based_mixing)
+            measure(results, "legacy project", project_view, legacy_texture, img_arr, uv_img_arr, alpha_arr,
+                    depth_arr, depth_based_mixing)
+            del view_input
+
+    measure(results, "resolve", session.resolve, False)
+    session.close()
+    measure(results, "finish", finish_texture, sparse_texture(rng, texture_size))
+    return results
+
+
+def print_results(render_size, texture_size, results):
+    print(F"\nrender {render_size}x{render_size}, texture {texture_size}x{texture_size}")
+    print(F"  {'stage':<20}{'total ms':>12}{'per call ms':>14}{'peak RSS MB':>14}{'growth MB':>12}")
+    for stage, entry in results.items():
+        memory = F"{'-':>14}{'-':>12}" if entry["peak_rss_mb"] is None else \
+            F"{entry['peak_rss_mb']:>14.1f}{entry['rss_growth_mb']:>12.1f}"
+        print(F"  {stage:<20}{entry['time'] * 1000:>12.1f}{entry['time'] * 1000 / entry['calls']:>14.1f}{memory}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark of the texture projection and finishing pipeline")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[512, 1024],
+                        help="Render resolutions of the synthetic passes")
+    parser.add_argument("--texture-sizes", type=int, nargs="+", default=[768, 2048])
+    parser.add_argument("--large", action="store_true",
+                        help="Also run 2048 and 4096 renders and 4096 textures, they need several GB of memory")
+    parser.add_argument("--views", type=int, default=3, help="Views projected into every texture")
+    parser.add_argument("--depth-based-mixing", action="store_true")
+    parser.add_argument("--check-size", type=int, default=24,
+                        help="Size of the fixtures compared against the reference loops, 0 skips the check")
+    parser.add_argument("--check-trials", type=int, default=5)
+    parser.add_argument("--json", help="Also write the results to this file, to track them between versions")
+    args = parser.parse_args()
+
+    if args.check_size:
+        mismatches = check_identity(args.check_size, args.check_trials)
+        if mismatches:
+            print("Output differs from the reference implementation:\n  " + "\n  ".join(mismatches))
+            sys.exit(1)
+        print(F"Output identical to the reference implementation ({args.check_trials} trials "
+              F"at {args.check_size}x{args.check_size})")
+
+    sizes = sorted(set(args.sizes + ([2048, 4096] if args.large else [])))
+    texture_sizes = sorted(set(args.texture_sizes + ([4096] if args.large else [])))
+    # A fresh process for every run, the peak RSS of a process only grows
+    context = multiprocessing.get_context("spawn")
+    report = []
+    for render_size in sizes:
+        for texture_size in texture_sizes:
+            with context.Pool(1) as pool:
+                results = pool.apply(benchmark, (render_size, texture_size, args.views, args.depth_based_mixing))
+            print_results(render_size, texture_size, results)
+            report.append({"render_size": render_size, "texture_size": texture_size, "views": args.views,
+                           "stages": results})
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,137 @@
+import hashlib
+import json
+
+import numpy as np
+
+from rasterizer import rasterize_triangles
+
+# Server-side render of the passes Blender writes through the compositor: UV, depth and alpha of a mesh seen
+# from a camera, drawn with a z-buffer over rasterize_triangles, and the diffuse pass sampled from the texture.
+# Cameras follow Blender: they look along their local -Z axis, and the sensor width is used for the larger
+# side of the render (sensor fit Auto). Triangles with a corner closer than NEAR_CLIP are not drawn.
+NEAR_CLIP = 0.01
+MESH_ARRAYS = ("positions", "triangles", "uvs")
+
+
+class Mesh:
+    # positions: (n, 3) vertices in world space, triangles: (m, 3) vertex indices,
+    # uvs: (m, 3, 2) UV coordinates of every triangle corner, so UV seams need no duplicated vertices
+    def __init__(self, positions, triangles, uvs):
+        self.positions = np.asarray(positions, dtype=np.float64).reshape(-1, 3)
+        self.triangles = np.asarray(triangles, dtype=np.int64).reshape(-1, 3)
+        self.uvs = np.asarray(uvs, dtype=np.float32).reshape(-1, 3, 2)
+        if len(self.uvs) != len(self.triangles):
+            raise ValueError("Every triangle needs the UV coordinates of its three corners")
+        if len(self.triangles) and (self.triangles.min() < 0 or self.triangles.max() >= len(self.positions)):
+            raise ValueError("Triangle vertex index out of range")
+        digest = hashlib.sha1()
+        for arr in (self.positions.astype(np.float32), self.triangles.astype(np.int32), self.uvs):
+            digest.update(arr.tobytes())
+        self.key = digest.hexdigest()
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        return cls(*(arrays[name] for name in MESH_ARRAYS))
+
+    @classmethod
+    def load_obj(cls, path):
+        # Vertices, texture coordinates and faces of a Wavefront OBJ file, polygons are split into triangle fans
+        positions, uvs, faces = [], [], []
+        with open(path) as f:
+            for line in f:
+                parts = line.split()
+                if not parts:
+                    continue
+                if parts[0] == "v":
+                    positions.append([float(value) for value in parts[1:4]])
+                elif parts[0] == "vt":
+                    uvs.append([float(value) for value in parts[1:3]])
+                elif parts[0] == "f":
+                    corners = [corner.split("/") for corner in parts[1:]]
+                    for num in range(1, len(corners) - 1):
+                        faces.append([corners[0], corners[num], corners[num + 1]])
+
+        def index(value, count):
+            value = int(value)
+            return value - 1 if value > 0 else count + value
+
+        triangles = [[index(corner[0], len(positions)) for corner in face] for face in faces]
+        # Corners without texture coordinates get (0, 0), they are left out of the UV pass like the background
+        uvs.append([0.0, 0.0])
+        corner_uvs = [[uvs[index(corner[1], len(uvs) - 1)] if len(corner) > 1 and corner[1] else uvs[-1]
+                       for corner in face] for face in faces]
+        return cls(positions, np.reshape(triangles, (-1, 3)), np.reshape(corner_uvs, (-1, 3, 2)))
+
+    def to_arrays(self):
+        return {"positions": self.positions.astype(np.float32), "triangles": self.triangles.astype(np.int32),
+                "uvs": self.uvs}
+
+
+def camera_view_key(mesh, camera):
+    # Same as the view_key of the add-on: the UV pass only depends on the mesh and the camera
+    return hashlib.sha1(bytes(F"{mesh.key}:{json.dumps(camera, sort_keys=True)}", "utf8")).hexdigest()
+
+
+def camera_axes(camera):
+    # Location and the right, up and backward axes of a camera given by its world matrix (4x4, rows as in
+    # Blender's matrix_world) or by its location and a target it looks at, with the world Z axis up
+    if "matrix" in camera:
+        matrix = np.asarray(camera["matrix"], dtype=np.float64)
+        axes = matrix[:3, :3].T / np.linalg.norm(matrix[:3, :3], axis=0)[:, np.newaxis]
+        return matrix[:3, 3], axes
+    location = np.asarray(camera["location"], dtype=np.float64)
+    back = location - np.asarray(camera.get("target", (0, 0, 0)), dtype=np.float64)
+    back /= np.linalg.norm(back)
+    right = np.cross([0.0, 0.0, 1.0], back)
+    if np.linalg.norm(right) < 1e-9:
+        # Looking straight up or down
+        right = np.array([1.0, 0.0, 0.0])
+    right /= np.linalg.norm(right)
+    return location, np.stack([right, np.cross(back, right), back])
+
+
+def render_mesh_passes(mesh, camera, sample_texture=None):
+    # Passes of the view in the format of the renders sent by the add-on: "uv" float32 (u, v, 0), "alpha" and
+    # "depth" uint8, top row first. Depth is normalized over the mesh like the Normalize node, the background
+    # is 255. sample_texture(uv) returns the current colors of the texture for the diffuse pass.
+    width, height = (int(value) for value in camera["resolution"])
+    location, axes = camera_axes(camera)
+    local = (mesh.positions - location) @ axes.T
+    distance = -local[:, 2]
+    focal = float(camera.get("lens", 50.0)) / float(camera.get("sensor_width", 36.0)) * max(width, height)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        screen = np.stack([width / 2 + focal * local[:, 0] / distance,
+                           height / 2 - focal * local[:, 1] / distance], axis=-1)
+
+    drawn = np.flatnonzero((distance[mesh.triangles] > NEAR_CLIP).all(axis=1))
+    pixels, tri, barycentric = rasterize_triangles((height, width), screen[mesh.triangles[drawn]])
+    tri = drawn[tri]
+
+    # Perspective correct interpolation: barycentric coordinates on the screen weighted by 1 / distance
+    weights = barycentric / distance[mesh.triangles[tri]]
+    depth = 1 / weights.sum(axis=1)
+    weights *= depth[:, np.newaxis]
+    # Z-buffer, the closest fragment of every pixel
+    order = np.lexsort((depth, pixels))
+    pixels, tri, depth, weights = pixels[order], tri[order], depth[order], weights[order]
+    closest = np.ones(len(pixels), dtype=bool)
+    closest[1:] = pixels[1:] != pixels[:-1]
+    pixels, tri, depth, weights = pixels[closest], tri[closest], depth[closest], weights[closest]
+
+    uv = np.zeros((height * width, 3), dtype=np.float32)
+    uv[pixels, :2] = np.einsum("nk,nkc->nc", weights, mesh.uvs[tri])
+    alpha = np.zeros(height * width, dtype=np.uint8)
+    alpha[pixels] = 255
+    depth_arr = np.full(height * width, 255, dtype=np.uint8)
+    if len(depth):
+        near, far = depth.min(), depth.max()
+        depth_arr[pixels] = np.round((depth - near) / max(far - near, 1e-9) * 255).astype(np.uint8)
+    diffuse = np.zeros((height * width, 3), dtype=np.uint8)
+    if sample_texture is not None and len(pixels):
+        diffuse[pixels] = sample_texture(uv[pixels])
+    return {
+        "depth": depth_arr.reshape(height, width),
+        "uv": uv.reshape(height, width, 3),
+        "alpha": alpha.reshape(height, width),
+        "diffuse": diffuse.reshape(height, width, 3),
+    }
@@ -1,8 +1,11 @@
+import contextlib
+import hashlib
 import pathlib
+import queue
 import socket
 import threading
-import time
 
+import numpy as np
 import requests
 import math
 import mathutils
@@ -10,120 +13,641 @@ import os
 import bpy
 from bpy.types import Operator
 
+from .sd_client import SDClient, decode_preview
+
+# Largest side of the texture previews sent to Blender while views are still generated
+PREVIEW_SIZE = 2048
+# Denoising steps between the previews of a generated view, shown in the PREVIEW_IMAGE_NAME image
+PREVIEW_STEPS = 5
+PREVIEW_IMAGE_NAME = "SD Preview"
+# Rows of a texture converted to Blender's float pixels at a time
+PIXEL_BAND_ROWS = 256
+# Seconds between the checks of the modal operator for messages from the generation thread
+MESSAGE_INTERVAL = 0.05
+
+MATERIAL_NAME = "SDResultMaterial"
+TEXTURE_NODE_NAME = "SD Texture"
+CAMERA_NAME = "SD Camera"
+# Scene property with the directory the compositor of the add-on writes the passes to, set when it is built
+COMPOSITOR_KEY = "sdtg4b_compositor"
+PASS_OUTPUTS = ("Depth Output", "UV Output", "Alpha Output", "Diffuse Output")
+# Cheapest EEVEE settings for the passes the server uses, settings missing in a Blender version are skipped
+RENDER_PROFILE = {
+    "taa_render_samples": 1,
+    "use_gtao": False,
+    "use_bloom": False,
+    "use_ssr": False,
+    "use_motion_blur": False,
+    "use_volumetric_lights": False,
+    "use_volumetric_shadows": False,
+    "use_soft_shadows": False,
+    "use_shadows": False,
+    "use_raytracing": False,
+    "shadow_cube_size": '512',
+    "shadow_cascade_size": '512',
+}
+
 
 class SDProcessor(threading.Thread):
-    waiting_for_render = False
-    waiting_for_refresh = False
-    camera_location = (0, 0, 0)
+    progress = 0.0
     stop = False
+    error = None
 
     def __init__(self,
-                 data, api_url, resolution_x, resolution_y, camera_r, camera_z, wm, views_num, camera):
+                 data, api_url, camera_r, camera_z, views_num, batch_views=False, max_batch_size=4, scene_key=None,
+                 pipeline_views=False, mesh=None, server_camera=None):
         self.data = data
         self.api_url = api_url
-        self.resolution_x = resolution_x
-        self.resolution_y = resolution_y
+        self.client = SDClient(api_url)
         self.camera_r = camera_r
         self.camera_z = camera_z
         self.views_num = views_num
-        self.camera = camera
-        self.iteration = 0
+        self.batch_views = batch_views
+        self.max_batch_size = max_batch_size
+        self.scene_key = scene_key
+        self.pipeline_views = pipeline_views
+        # Mesh arrays and camera settings of views rendered by the server, Blender renders them without a mesh
+        self.mesh = mesh
+        self.server_camera = server_camera
+        self.session_id = None
+        # (step parameters, camera location) of every view
+        self.plan = []
+        # Jobs submitted to the server and not finished yet, cancelled together
+        self.job_ids = []
+        # Seconds spent in every server stage (decode, diffusion, project...) summed over the finished jobs
+        self.timings = dict()
+        # bpy is only used on the main thread: renders, textures and previews go there as (kind, value) messages
+        # drained by the modal operator, rendered passes come back through their own queue
+        self.messages = queue.Queue()
+        self.rendered = queue.Queue()
         threading.Thread.__init__(self)
 
-    def finish_texture(self):
-        data = self.data.copy()
-        response = requests.get(self.api_url + "/finish_texture", json=data)
-        print(response.status_code, response.text)
-
-    def depth2img(self, **kwargs):
+    def submit_job(self, path, **kwargs):
         data = self.data.copy()
         data.update(kwargs)
-        try:
-            requests.get(self.api_url + "/depth2img_step", json=data, timeout=1)
-        except (requests.exceptions.ConnectionError,
-                requests.exceptions.Timeout,
-                requests.exceptions.ReadTimeout):
-            pass
+        job_id = self.client.submit_job(path, data)
+        self.job_ids.append(job_id)
+        return job_id
 
-        while True:
-            try:
-                requests.get(self.api_url + "/status", json={}, timeout=1)
-            except (requests.exceptions.ConnectionError,
-                    requests.exceptions.Timeout,
-                    requests.exceptions.ReadTimeout):
-                continue
-            break
-
-    def render_view(self, angle, z_offset=2, radius=7):
-        print(F"Rendering: {angle} in thread.")
-
-        angle_radians = 2 * math.pi * angle / 360
+    def wait_for_job(self, job_id, progress_range=(0.0, 1.0)):
+        start, end = progress_range
 
-        # Randomly place the camera on a circle around the object at the same height as the main camera
-        new_camera_pos = mathutils.Vector((self.camera_r * math.cos(angle_radians),
-                                           radius * math.sin(angle_radians),
-                                           self.camera_z))
-        self.camera_location = new_camera_pos
+        def on_event(event, payload):
+            if payload["progress"] is not None:
+                self.progress = start + (end - start) * payload["progress"]["fraction"]
+            if event == "preview":
+                self.messages.put(("preview", decode_preview(payload)))
 
-        # Render UVs and Depth
-        self.waiting_for_render = True
-        while self.waiting_for_render:
-            time.sleep(1)
-        self.iteration += 1
-
-    def run(self):
+        job = wait_for_job(self.client, job_id, on_event)
+        self.job_ids.remove(job_id)
+        if self.stop:
+            return None
+        check_job(job)
+        stages = ", ".join(F"{name} {stage_time:.2f}s" for name, stage_time in job["stages"].items())
+        print(F"Job {job['kind']} done in {job['run_time']:.2f}s (queued for {job['wait_time']:.2f}s): {stages}")
+        for name, stage_time in job["stages"].items():
+            self.timings[name] = self.timings.get(name, 0.0) + stage_time
+        self.progress = end
+        return job
+
+    def cancel_job(self):
+        # Called on the main thread, it only flags this thread. The server-side work is cancelled from a background
+        # thread with its own client, the client of this thread may be streaming the events of a job. The running
+        # job ends after its current denoising step.
+        self.stop = True
+        self.rendered.put(None)
+        threading.Thread(target=cancel_jobs, args=(self.api_url, list(self.job_ids)), daemon=True).start()
+
+    def create_session(self):
+        self.session_id = self.client.create_session({"out_txt": self.data["out_txt"],
+                                                      "texture_size": self.data["texture_size"]})
+        self.data["session_id"] = self.session_id
+
+    def discard_session(self):
+        self.client.discard_session(self.session_id)
+        self.session_id = None
+
+    def fetch_texture(self):
+        # Only a preview of large textures is sent, the full resolution one is written by the finishing step
+        self.messages.put(("texture", self.client.texture(self.session_id, max_size=PREVIEW_SIZE)))
 
-        number_of_renders = self.views_num
-        for num in range(number_of_renders):
-            angle = 360 * num / number_of_renders
-            self.render_view(angle)
-            if self.stop:
-                return
-            self.depth2img()
-            bpy.context.window_manager.progress_update(70 * num // number_of_renders)
-            if self.stop:
-                return
-        # top part problem
-        self.render_view(0, z_offset=3, radius=3)
+    def finish_texture(self):
+        # The finishing step sends back the texture it wrote when it is not larger than PREVIEW_SIZE, it goes
+        # straight into the image of the material. Larger textures are read from the written file instead.
+        job_id = self.submit_job("/session/finish", return_texture_size=PREVIEW_SIZE)
+        job = self.wait_for_job(job_id, progress_range=(self.progress, 1.0))
         if self.stop:
             return
-        self.depth2img(strength=0.5)
-        bpy.context.window_manager.progress_update(80)
+        self.session_id = None
+        if job["result"]:
+            self.messages.put(("texture", self.client.job_result(job_id)["texture"]))
+        else:
+            self.messages.put(("reload", None))
 
-        self.render_view(0)
+    def render_view(self, num, camera_location):
+        print(F"Rendering view {num} in thread.")
+        # Render UVs and Depth
+        self.messages.put(("render", camera_location))
+        passes = self.rendered.get()
         if self.stop:
+            return None
+        if passes is None:
+            raise RuntimeError(F"Rendering of view {num} failed")
+        if self.batch_views:
+            self.progress = 0.3 * (num + 1) / len(self.plan)
+        return passes, view_key(self.scene_key, camera_location)
+
+    def wait_for_view(self, num, job_id):
+        # Views of a batch are generated together, after the renders
+        if self.batch_views:
+            progress_range = (self.progress, 0.9)
+        else:
+            progress_range = (0.9 * num / len(self.plan), 0.9 * (num + 1) / len(self.plan))
+        job = self.wait_for_job(job_id, progress_range)
+        if job is not None:
+            self.fetch_texture()
+        return job
+
+    def run(self):
+        try:
+            self.create_session()
+            self.generate()
+        except (RuntimeError, requests.exceptions.RequestException) as e:
+            self.error = str(e)
+            print(self.error)
+        finally:
+            if self.stop and self.job_ids:
+                # Jobs submitted after the cancellation started
+                cancel_jobs(self.api_url, self.job_ids)
+            # Cancelled or failed runs leave an unfinished session on the server
+            if self.session_id is not None:
+                try:
+                    self.discard_session()
+                except (RuntimeError, requests.exceptions.RequestException):
+                    pass
+            self.client.close()
+
+    def generate(self):
+        self.plan = camera_plan(self.views_num, self.camera_r, self.camera_z)
+        pending = submit_plan(self.client, self.data, self.plan, self.job_ids, self.render_view, self.wait_for_view,
+                              batch_views=self.batch_views, pipeline_views=self.pipeline_views,
+                              max_batch_size=self.max_batch_size, mesh=self.mesh, server_camera=self.server_camera)
+        if pending is None:
             return
-        self.depth2img(strength=0.5)
-        bpy.context.window_manager.progress_update(90)
+        for num, job_id in enumerate(pending, len(self.plan) - len(pending)):
+            if self.wait_for_view(num, job_id) is None:
+                return
 
         self.finish_texture()
 
-        bpy.context.window_manager.progress_update(100)
-        bpy.context.window_manager.progress_end()
-        self.waiting_for_refresh = True
-
 
-def create_material(txt_path):
-    output_image = bpy.data.images.new(str(txt_path), width=768, height=768)
+def cancel_jobs(api_url, job_ids):
+    client = SDClient(api_url)
+    try:
+        for job_id in job_ids:
+            try:
+                client.cancel_job(job_id)
+            except (RuntimeError, requests.exceptions.RequestException):
+                pass
+    finally:
+        client.close()
+
+
+def submit_views(client, data, views, **kwargs):
+    # One /depth2img_raw job for views, a list of (step parameters, rendered passes)
+    data = dict(data, views=[params for params, _ in views], **kwargs)
+    arrays = dict()
+    for num, (_, passes) in enumerate(views):
+        for name, arr in passes.items():
+            arrays[F"{num}/{name}"] = arr
+    return client.submit_arrays("/depth2img_raw", data, arrays)
+
+
+def wait_for_job(client, job_id, on_event=None):
+    # The server pushes the state and denoising progress of the job and its previews as server-sent events,
+    # the stream ends when the job is finished. Returns the final state of the job.
+    job = None
+    for event, payload in client.job_events(job_id):
+        if on_event is not None:
+            on_event(event, payload)
+        if event == "job":
+            job = payload
+    return job
+
+
+def check_job(job):
+    if job["state"] == "error":
+        raise RuntimeError(F"Job {job['kind']} failed on the server: {job['error']}")
+    if job["state"] != "done":
+        raise RuntimeError(F"Job {job['kind']} was cancelled on the server")
+    return job
+
+
+def submit_plan(client, data, plan, job_ids, render, wait, batch_views=False, pipeline_views=False,
+                max_batch_size=4, mesh=None, server_camera=None):
+    # Submits the views of plan, (step parameters, camera location) pairs, to the texture session of data and
+    # appends the ids of the jobs to job_ids. render(num, camera_location) renders a view in Blender and returns
+    # its passes and view key, wait(num, job_id) waits for the job of a view and updates the texture. Both return
+    # None when the generation is stopped, so does this function. Otherwise it returns the ids of the jobs that
+    # are not waited for yet, in order.
+    def submit(job_id):
+        job_ids.append(job_id)
+        return job_id
+
+    if mesh is not None:
+        # The server renders the passes from the uploaded mesh, so all views are queued right away. Jobs of
+        # a session run in order and render their views when they start, every view sees the previous ones.
+        client.upload_mesh(data["session_id"], mesh)
+        views = [dict(step_kwargs, camera=dict(server_camera, location=list(camera_location)))
+                 for step_kwargs, camera_location in plan]
+        if batch_views:
+            return [submit(client.submit_job("/depth2img_mesh", dict(data, views=views,
+                                                                     max_batch_size=max_batch_size)))]
+        return [submit(client.submit_job("/depth2img_mesh", dict(data, views=[view]))) for view in views]
+
+    if batch_views:
+        views = []
+        for num, (step_kwargs, camera_location) in enumerate(plan):
+            rendered = render(num, camera_location)
+            if rendered is None:
+                return None
+            passes, key = rendered
+            views.append((dict(step_kwargs, view_key=key), passes))
+        return [submit(submit_views(client, data, views, max_batch_size=max_batch_size))]
+
+    # Views are rendered with the texture generated so far. With pipeline_views the next view is rendered and
+    # uploaded while the server diffuses the current one, it only sees the texture up to the view before it.
+    lag = 2 if pipeline_views else 1
+    pending = []
+    for num, (step_kwargs, camera_location) in enumerate(plan):
+        if len(pending) == lag and wait(num - lag, pending.pop(0)) is None:
+            return None
+        rendered = render(num, camera_location)
+        if rendered is None:
+            return None
+        passes, key = rendered
+        pending.append(submit(submit_views(client, data, [(dict(step_kwargs, view_key=key), passes)])))
+    return pending
+
+
+def view_plan(views_num):
+    # Camera placement and step parameters of every generated view
+    plan = [(dict(angle=360 * num / views_num), dict()) for num in range(views_num)]
+    # top part problem
+    plan.append((dict(angle=0, z_offset=3, radius=3), dict(strength=0.5)))
+    plan.append((dict(angle=0), dict(strength=0.5)))
+    return plan
+
+
+def camera_position(angle, camera_r, camera_z, radius=7):
+    angle_radians = 2 * math.pi * angle / 360
+    # Randomly place the camera on a circle around the object at the same height as the main camera
+    return mathutils.Vector((camera_r * math.cos(angle_radians),
+                             radius * math.sin(angle_radians),
+                             camera_z))
+
+
+def camera_plan(views_num, camera_r, camera_z):
+    # Step parameters and camera location of every generated view
+    return [(step_kwargs, camera_position(view["angle"], camera_r, camera_z, view.get("radius", 7)))
+            for view, step_kwargs in view_plan(views_num)]
+
+
+def view_key(scene_key, camera_location):
+    # Same mesh, camera pose and resolution give the same UV pass, the server reuses its texel index
+    if scene_key is None:
+        return None
+    pose = ",".join(F"{value:.5f}" for value in camera_location)
+    return hashlib.sha1(bytes(F"{scene_key}:{pose}", "utf8")).hexdigest()
+
+
+def add_camera(target):
+    # The camera of the views is added by the first run and reused by the next ones
+    camera = bpy.context.scene.objects.get(CAMERA_NAME)
+    if camera is None or camera.type != 'CAMERA':
+        bpy.ops.object.camera_add(enter_editmode=False)
+        camera = bpy.context.object
+        camera.name = CAMERA_NAME
+    bpy.context.scene.camera = camera
+
+    # Add a new track to constraint and set it to track your object
+    track_to = camera.constraints.get("SD Track To")
+    if track_to is None:
+        track_to = camera.constraints.new('TRACK_TO')
+        track_to.name = "SD Track To"
+    track_to.target = target
+    track_to.track_axis = 'TRACK_NEGATIVE_Z'
+    track_to.up_axis = 'UP_Y'
+    return camera
+
+
+def render_passes(camera_location, resolution_x, resolution_y, tmp_path, frame_code):
+    # The texture of the material is kept up to date in memory, no image is reloaded from disk before a render
+
+    scene = bpy.data.scenes['Scene']
+    bpy.context.scene.camera.location = camera_location
+    with render_profile(scene, resolution_x, resolution_y):
+        bpy.ops.render.render()
+    return read_passes(pass_paths(tmp_path, frame_code))
+
+
+def pass_paths(tmp_path, frame_code):
+    return {
+        "depth": str(tmp_path / F"depth{frame_code}.bmp"),
+        "uv": str(tmp_path / F"uv{frame_code}.exr"),
+        "alpha": str(tmp_path / F"alpha{frame_code}.png"),
+        "diffuse": str(tmp_path / F"diffuse{frame_code}.bmp"),
+    }
+
+
+def load_pass(path, channels, colorspace=None):
+    img = bpy.data.images.load(path, check_existing=False)
+    try:
+        if colorspace is not None:
+            img.colorspace_settings.name = colorspace
+        width, height = img.size
+        pixels = np.empty(width * height * 4, dtype=np.float32)
+        img.pixels.foreach_get(pixels)
+    finally:
+        bpy.data.images.remove(img)
+    # Blender stores the bottom row first
+    return np.ascontiguousarray(np.flipud(pixels.reshape(height, width, 4))[..., :channels])
+
+
+def read_passes(paths):
+    def to_uint8(arr):
+        return np.round(np.clip(arr, 0, 1) * 255).astype(np.uint8)
+
+    return {
+        "depth": to_uint8(load_pass(paths["depth"], 1)[..., 0]),
+        "uv": load_pass(paths["uv"], 3, colorspace='Non-Color'),
+        "alpha": to_uint8(load_pass(paths["alpha"], 1)[..., 0]),
+        "diffuse": to_uint8(load_pass(paths["diffuse"], 3)),
+    }
+
+
+def set_image_pixels(image, arr):
+    height, width = arr.shape[:2]
+    if tuple(image.size) != (width, height):
+        image.scale(width, height)
+    # Converted bottom row first a band of rows at a time, Blender's buffer is the only float copy of the texture
+    pixels = np.empty((height, width, 4), dtype=np.float32)
+    flipped = arr[::-1]
+    for start in range(0, height, PIXEL_BAND_ROWS):
+        band = pixels[start:start + PIXEL_BAND_ROWS]
+        np.multiply(flipped[start:start + PIXEL_BAND_ROWS, :, :3], np.float32(1 / 255), out=band[..., :3])
+        band[..., 3] = 1.0
+    image.pixels.foreach_set(pixels.ravel())
+    image.update()
+
+
+def scene_key(target, camera, resolution_x, resolution_y):
+    # Hash of everything besides the camera position that decides where the pixels of a view land in the texture
+    depsgraph = bpy.context.evaluated_depsgraph_get()
+    evaluated = target.evaluated_get(depsgraph)
+    mesh = evaluated.to_mesh()
+    try:
+        digest = hashlib.sha1()
+        coords = np.empty(len(mesh.vertices) * 3, dtype=np.float32)
+        mesh.vertices.foreach_get("co", coords)
+        digest.update(coords.tobytes())
+        loops = np.empty(len(mesh.loops), dtype=np.int32)
+        mesh.loops.foreach_get("vertex_index", loops)
+        digest.update(loops.tobytes())
+        if mesh.uv_layers.active is not None:
+            uvs = np.empty(len(mesh.uv_layers.active.data) * 2, dtype=np.float32)
+            mesh.uv_layers.active.data.foreach_get("uv", uvs)
+            digest.update(uvs.tobytes())
+    finally:
+        evaluated.to_mesh_clear()
+    digest.update(np.array(target.matrix_world, dtype=np.float32).tobytes())
+    digest.update(bytes(F"{camera.data.lens}:{camera.data.sensor_width}:{resolution_x}x{resolution_y}", "utf8"))
+    return digest.hexdigest()
+
+
+def mesh_arrays(target):
+    # Triangles of the evaluated mesh in world space with the UVs of their corners, for views rendered on the server
+    depsgraph = bpy.context.evaluated_depsgraph_get()
+    evaluated = target.evaluated_get(depsgraph)
+    mesh = evaluated.to_mesh()
+    try:
+        mesh.calc_loop_triangles()
+        positions = np.empty(len(mesh.vertices) * 3, dtype=np.float32)
+        mesh.vertices.foreach_get("co", positions)
+        triangles = np.empty(len(mesh.loop_triangles) * 3, dtype=np.int32)
+        mesh.loop_triangles.foreach_get("vertices", triangles)
+        loops = np.empty(len(mesh.loop_triangles) * 3, dtype=np.int32)
+        mesh.loop_triangles.foreach_get("loops", loops)
+        uvs = np.zeros(len(mesh.loops) * 2, dtype=np.float32)
+        if mesh.uv_layers.active is not None:
+            mesh.uv_layers.active.data.foreach_get("uv", uvs)
+    finally:
+        evaluated.to_mesh_clear()
+    matrix = np.array(target.matrix_world, dtype=np.float64)
+    positions = positions.reshape(-1, 3) @ matrix[:3, :3].T + matrix[:3, 3]
+    return {"positions": positions.astype(np.float32), "triangles": triangles.reshape(-1, 3),
+            "uvs": uvs.reshape(-1, 2)[loops].reshape(-1, 3, 2)}
+
+
+def server_camera(camera, target, resolution_x, resolution_y):
+    # Camera settings of views rendered on the server, the camera tracks the origin of the target
+    return {
+        "target": list(target.matrix_world.translation),
+        "lens": camera.data.lens,
+        "sensor_width": camera.data.sensor_width,
+        "resolution": [resolution_x, resolution_y],
+    }
+
+
+def texture_image(txt_path, size=768):
+    # Image of the generated texture, reused by the next runs. An existing file is loaded, a missing one is
+    # created blank.
+    txt_path = str(txt_path)
+    output_image = next((img for img in bpy.data.images if img.filepath == txt_path), None)
+    if os.path.exists(txt_path):
+        if output_image is None:
+            return bpy.data.images.load(txt_path)
+        output_image.source = 'FILE'
+        output_image.reload()
+        return output_image
+
+    if output_image is None:
+        output_image = bpy.data.images.new(txt_path, width=size, height=size)
+    elif tuple(output_image.size) != (size, size):
+        output_image.scale(size, size)
+    pixels = np.zeros((size * size, 4), dtype=np.float32)
+    pixels[:, 3] = 1
+    output_image.pixels.foreach_set(pixels.ravel())
     output_image.file_format = 'PNG'
-    output_image.filepath = str(txt_path)
+    output_image.filepath = txt_path
     output_image.save()
+    return output_image
+
 
-    mat = bpy.data.materials.get("SDResultMaterial")
+def create_material(txt_path, size=768):
+    output_image = texture_image(txt_path, size)
+    mat = bpy.data.materials.get(MATERIAL_NAME)
     if mat is None:
-        mat = bpy.data.materials.new(name="SDResultMaterial")
+        mat = bpy.data.materials.new(name=MATERIAL_NAME)
     mat.use_nodes = True
-    principled = mat.node_tree.nodes.get('Principled BSDF')
-
-    tex_node = mat.node_tree.nodes.new('ShaderNodeTexImage')
+    nodes = mat.node_tree.nodes
+
+    # Nodes added by a previous run are reused
+    tex_node = nodes.get(TEXTURE_NODE_NAME)
+    if tex_node is None:
+        tex_node = nodes.new('ShaderNodeTexImage')
+        tex_node.name = TEXTURE_NODE_NAME
+        mat.node_tree.links.new(tex_node.outputs[0], nodes.get('Principled BSDF').inputs[0])
     tex_node.image = output_image
-    mat.node_tree.links.new(tex_node.outputs[0], principled.inputs[0])
 
-    uv_node = mat.node_tree.nodes.new("ShaderNodeTexCoord")
-    aov_out_node = mat.node_tree.nodes.new("ShaderNodeOutputAOV")
-    aov_out_node.name = "UV"
-    mat.node_tree.links.new(uv_node.outputs[2], aov_out_node.inputs[0])
-    return mat
+    if nodes.get("UV") is None:
+        uv_node = nodes.new("ShaderNodeTexCoord")
+        aov_out_node = nodes.new("ShaderNodeOutputAOV")
+        aov_out_node.name = "UV"
+        if hasattr(aov_out_node, "aov_name"):
+            aov_out_node.aov_name = "UV"
+        mat.node_tree.links.new(uv_node.outputs[2], aov_out_node.inputs[0])
+    return mat, output_image
+
+
+@contextlib.contextmanager
+def render_profile(scene, resolution_x, resolution_y):
+    # Only the passes read by the add-on, at the lowest cost. The render settings of the user are restored after
+    # the render, also when it fails.
+    render = scene.render
+    saved = [(render, name, getattr(render, name)) for name in (
+        "film_transparent", "engine", "use_motion_blur", "resolution_percentage", "resolution_x", "resolution_y")]
+    saved += [(scene.eevee, name, getattr(scene.eevee, name)) for name in RENDER_PROFILE if hasattr(scene.eevee, name)]
+    try:
+        render.film_transparent = True
+        try:
+            render.engine = 'BLENDER_EEVEE'
+        except TypeError:
+            # Blender 4.2 to 4.4
+            render.engine = 'BLENDER_EEVEE_NEXT'
+        render.use_motion_blur = False
+        render.resolution_percentage = 100
+        render.resolution_x = resolution_x
+        render.resolution_y = resolution_y
+        for name, value in RENDER_PROFILE.items():
+            if hasattr(scene.eevee, name):
+                setattr(scene.eevee, name, value)
+        yield
+    finally:
+        for owner, name, value in saved:
+            setattr(owner, name, value)
+
+
+def enable_passes(scene):
+    view_layer = scene.view_layers["ViewLayer"]
+    view_layer.use_pass_diffuse_color = True
+    view_layer.use_pass_combined = True
+    view_layer.use_pass_z = True
+    try:
+        view_layer.uv = False
+    except Exception:
+        pass
+    if "UV" not in [aov.name for aov in view_layer.aovs]:
+        bpy.ops.scene.view_layer_add_aov()
+        view_layer.active_aov.name = "UV"
+
+
+def compositor_ready(scene, tmp_path):
+    if not scene.use_nodes or scene.node_tree is None or scene.get(COMPOSITOR_KEY) != str(tmp_path):
+        return False
+    outputs = {node.label: node for node in scene.node_tree.nodes if node.type == 'OUTPUT_FILE'}
+    return all(label in outputs and outputs[label].base_path == str(tmp_path) for label in PASS_OUTPUTS)
+
+
+def build_compositor(scene, tmp_path):
+    scene.use_nodes = True
+    tree = scene.node_tree
+    for node in tree.nodes:
+        tree.nodes.remove(node)
+
+    render_layers = tree.nodes.new('CompositorNodeRLayers')
+
+    # depth
+    depth_file_output = tree.nodes.new(type="CompositorNodeOutputFile")
+    depth_file_output.label = 'Depth Output'
+    depth_file_output.base_path = str(tmp_path)
+    depth_file_output.file_slots[0].path = "depth"
+    depth_file_output.file_slots[0].use_node_format = True
+    depth_file_output.format.file_format = "BMP"
+
+    normalize_node = tree.nodes.new(type="CompositorNodeNormalize")
+
+    tree.links.new(render_layers.outputs['Depth'], normalize_node.inputs[0])
+    tree.links.new(normalize_node.outputs['Value'], depth_file_output.inputs[0])
+
+    # uv
+    uv_file_output = tree.nodes.new(type="CompositorNodeOutputFile")
+    uv_file_output.label = 'UV Output'
+    uv_file_output.base_path = str(tmp_path)
+    uv_file_output.file_slots[0].path = "uv"
+    uv_file_output.file_slots[0].use_node_format = True
+    uv_file_output.format.file_format = "OPEN_EXR"
+    uv_file_output.format.color_depth = '32'
+    tree.links.new(render_layers.outputs['UV'], uv_file_output.inputs[0])
+
+    # alpha
+    alpha_file_output = tree.nodes.new(type="CompositorNodeOutputFile")
+    alpha_file_output.label = 'Alpha Output'
+    alpha_file_output.base_path = str(tmp_path)
+    alpha_file_output.file_slots[0].path = "alpha"
+    alpha_file_output.file_slots[0].use_node_format = True
+    alpha_file_output.format.file_format = "PNG"
+    alpha_file_output.format.color_mode = "BW"
+    tree.links.new(render_layers.outputs['Alpha'], alpha_file_output.inputs[0])
+
+    # diffuse
+    diffuse_file_output = tree.nodes.new(type="CompositorNodeOutputFile")
+    diffuse_file_output.label = 'Diffuse Output'
+    diffuse_file_output.base_path = str(tmp_path)
+    diffuse_file_output.file_slots[0].path = "diffuse"
+    diffuse_file_output.file_slots[0].use_node_format = True
+    diffuse_file_output.format.file_format = "BMP"
+
+    luma_key_node = tree.nodes.new("CompositorNodeLumaMatte")
+    luma_key_node.limit_max = 0.01
+    luma_key_node.limit_min = 0.00
+    tree.links.new(render_layers.outputs['DiffCol'], luma_key_node.inputs[0])
+
+    mix_node = tree.nodes.new("CompositorNodeMixRGB")
+    tree.links.new(luma_key_node.outputs['Matte'], mix_node.inputs[0])
+    tree.links.new(render_layers.outputs['Image'], mix_node.inputs[1])
+    tree.links.new(render_layers.outputs['DiffCol'], mix_node.inputs[2])
+
+    tree.links.new(mix_node.outputs['Image'], diffuse_file_output.inputs[0])
+    scene[COMPOSITOR_KEY] = str(tmp_path)
+
+
+def setup_scene(target, tmp_path, txt_path, clear_txt=True, texture_size=768):
+    # Material with the generated texture on the target and compositor outputs of the passes sent to the server.
+    # Everything a previous run has set up is reused. Returns the name of the texture image.
+    print("Preparing the scene..")
+    scene = bpy.context.scene
+
+    # Create/use material
+    if clear_txt and os.path.exists(txt_path):
+        os.remove(txt_path)
+    mat, output_image = create_material(txt_path, texture_size)
+
+    if target.data.materials:
+        target.data.materials[0] = mat
+    else:
+        # no slots
+        target.data.materials.append(mat)
+
+    bpy.context.window_manager.progress_update(33)
+
+    # Render and composition
+    enable_passes(scene)
+    if not compositor_ready(scene, tmp_path):
+        build_compositor(scene, tmp_path)
+
+    bpy.context.window_manager.progress_update(99)
+    return output_image.name
 
 
 # ------------------------------------------------------------------------
@@ -154,7 +678,13 @@ class WM_OT_RunSD(Operator):
             return {'FINISHED'}
         global PROCESS_CACHE
         script_path = os.path.dirname(__file__) + os.sep + "start_sd_server.py"
-        PROCESS_CACHE = subprocess.Popen(["conda", "run", "-n", "SDTG4B_CONDA", "python", script_path])
+        import tempfile
+        # The server keeps the saved view indexes under --index-disk-mb, the oldest ones are removed
+        index_dir = os.path.join(tempfile.gettempdir(), "sdtg4b_view_index")
+        PROCESS_CACHE = subprocess.Popen(["conda", "run", "-n", "SDTG4B_CONDA", "python", script_path,
+                                          "--host", sd_tool.host, "--port", str(sd_tool.port),
+                                          "--index-dir", index_dir])
+        self.report({"INFO"}, "SD server is starting, the model is loaded in the background.")
         return {'FINISHED'}
 
 
@@ -185,7 +715,7 @@ class WM_OT_CreateMaterial(Operator):
             txt_path = str(self.result_path / "txt.png")
         else:
             txt_path = self.sd_tool.out_txt
-        create_material(txt_path)
+        create_material(txt_path, sd_tool.texture_size)
 
         return {'FINISHED'}
 
@@ -202,194 +732,94 @@ class WM_OT_GenerateTxt(Operator):
     txt_path = pathlib.Path()
     wm = None
     t = None
-    progress = 0.0
+    frame_code = ""
+    output_image_name = ""
     _timer = None
     t_cache = list()
 
     def generate_data(self):
-        frame_code = "{0:0>4}".format(bpy.context.scene.frame_current)
-
         return {
             "prompt": self.sd_tool.prompt,
             "n_prompt": self.sd_tool.negative_prompt,
-            "depth": str(self.tmp_path / F"depth{frame_code}.bmp"),
-            "uv": str(self.tmp_path / F"uv{frame_code}.exr"),
             "out_txt": self.txt_path,
-            "render": str(self.tmp_path / F"Image{frame_code}.png"),
-            "alpha": str(self.tmp_path / F"alpha{frame_code}.png"),
-            "diffuse": str(self.tmp_path / F"diffuse{frame_code}.bmp"),
             "depth_based_mixing": self.sd_tool.depth_based_blending,
             "steps": self.sd_tool.num_inference_steps,
             "guidance_scale": self.sd_tool.guidance_scale,
-            "seed": self.sd_tool.seed
+            "seed": self.sd_tool.seed,
+            "texture_size": self.sd_tool.texture_size,
+            "projection": self.sd_tool.projection,
+            "preview_steps": PREVIEW_STEPS
         }
 
     def setup_composition_nodes_and_material(self):
-        print("Preparing the scene..")
-        # Materials, textures...
-        bpy.context.scene.use_nodes = True
-        tree = bpy.context.scene.node_tree
-        for node in tree.nodes:
-            if node.label == "Output":
-                node.base_path = str(pathlib.Path(self.result_path))
-
-        bpy.context.window_manager.progress_update(33)
-
-        # Create/use material
-        if self.sd_tool.clear_txt and os.path.exists(self.txt_path):
-            os.remove(self.txt_path)
-        mat = create_material(self.txt_path)
-
-        if self.sd_tool.target.data.materials:
-            self.sd_tool.target.data.materials[0] = mat
-        else:
-            # no slots
-            self.sd_tool.target.data.materials.append(mat)
-
-        # Render and composition
-        bpy.context.scene.use_nodes = True
-        tree = bpy.context.scene.node_tree
-        for node in tree.nodes:
-            tree.nodes.remove(node)
-
-        bpy.data.scenes["Scene"].view_layers["ViewLayer"].use_pass_diffuse_color = True
-        bpy.data.scenes["Scene"].view_layers["ViewLayer"].use_pass_combined = True
-        bpy.data.scenes["Scene"].view_layers["ViewLayer"].use_pass_z = True
-        try:
-            bpy.data.scenes["Scene"].view_layers["ViewLayer"].uv = False
-        except Exception:
-            pass
-        bpy.ops.scene.view_layer_add_aov()
-        bpy.data.scenes["Scene"].view_layers["ViewLayer"].active_aov.name = "UV"
-
-        bpy.data.scenes["Scene"].render.film_transparent = True
-        bpy.data.scenes["Scene"].render.engine = 'BLENDER_EEVEE'
-
-        render_layers = tree.nodes.new('CompositorNodeRLayers')
-
-        # depth
-        depth_file_output = tree.nodes.new(type="CompositorNodeOutputFile")
-        depth_file_output.label = 'Depth Output'
-        depth_file_output.base_path = str(self.tmp_path)
-        depth_file_output.file_slots[0].path = "depth"
-        depth_file_output.file_slots[0].use_node_format = True
-        depth_file_output.format.file_format = "BMP"
-
-        normalize_node = tree.nodes.new(type="CompositorNodeNormalize")
-
-        tree.links.new(render_layers.outputs['Depth'], normalize_node.inputs[0])
-        tree.links.new(normalize_node.outputs['Value'], depth_file_output.inputs[0])
-
-        bpy.context.window_manager.progress_update(70)
-
-        # uv
-        uv_file_output = tree.nodes.new(type="CompositorNodeOutputFile")
-        uv_file_output.label = 'UV Output'
-        uv_file_output.base_path = str(self.tmp_path)
-        uv_file_output.file_slots[0].path = "uv"
-        uv_file_output.file_slots[0].use_node_format = True
-        uv_file_output.format.file_format = "OPEN_EXR"
-        uv_file_output.format.color_depth = '32'
-        tree.links.new(render_layers.outputs['UV'], uv_file_output.inputs[0])
-
-        bpy.context.window_manager.progress_update(80)
-
-        # alpha
-        alpha_file_output = tree.nodes.new(type="CompositorNodeOutputFile")
-        alpha_file_output.label = 'Alpha Output'
-        alpha_file_output.base_path = str(self.tmp_path)
-        alpha_file_output.file_slots[0].path = "alpha"
-        alpha_file_output.file_slots[0].use_node_format = True
-        alpha_file_output.format.file_format = "PNG"
-        alpha_file_output.format.color_mode = "BW"
-        tree.links.new(render_layers.outputs['Alpha'], alpha_file_output.inputs[0])
-
-        bpy.context.window_manager.progress_update(90)
-
-        # diffuse
-        diffuse_file_output = tree.nodes.new(type="CompositorNodeOutputFile")
-        diffuse_file_output.label = 'Diffuse Output'
-        diffuse_file_output.base_path = str(self.tmp_path)
-        diffuse_file_output.file_slots[0].path = "diffuse"
-        diffuse_file_output.file_slots[0].use_node_format = True
-        diffuse_file_output.format.file_format = "BMP"
-
-        luma_key_node = tree.nodes.new("CompositorNodeLumaMatte")
-        luma_key_node.limit_max = 0.01
-        luma_key_node.limit_min = 0.00
-        tree.links.new(render_layers.outputs['DiffCol'], luma_key_node.inputs[0])
-
-        mix_node = tree.nodes.new("CompositorNodeMixRGB")
-        tree.links.new(luma_key_node.outputs['Matte'], mix_node.inputs[0])
-        tree.links.new(render_layers.outputs['Image'], mix_node.inputs[1])
-        tree.links.new(render_layers.outputs['DiffCol'], mix_node.inputs[2])
-
-        tree.links.new(mix_node.outputs['Image'], diffuse_file_output.inputs[0])
-
-        # Image
-
-        # alpha
-        image_file_output = tree.nodes.new(type="CompositorNodeOutputFile")
-        image_file_output.label = 'Alpha Output'
-        image_file_output.base_path = str(self.tmp_path)
-        image_file_output.file_slots[0].path = "Image"
-        image_file_output.file_slots[0].use_node_format = True
-        image_file_output.format.file_format = "PNG"
-        tree.links.new(render_layers.outputs['Image'], image_file_output.inputs[0])
-
-        bpy.context.window_manager.progress_update(99)
+        self.output_image_name = setup_scene(self.sd_tool.target, self.tmp_path, self.txt_path, self.sd_tool.clear_txt,
+                                             self.sd_tool.texture_size)
 
     def modal(self, context, event):
         if event.type in {'ESC'}:
             self.cancel(context)
             return {'CANCELLED'}
 
-        if event.type == 'TIMER' and self.t is not None:
-            min_value = 100 * (max(self.t.iteration - 1, 0) / (self.t.views_num + 2))
-            max_value = 100 * (self.t.iteration / (self.t.views_num + 2))
-            delta = max_value - min_value
-            self.progress += 0.05 * (delta - self.progress)
-            bpy.context.window_manager.progress_update(min_value + + self.progress)
-
-        if self.t is not None and self.t.is_alive():
-            if self.t.waiting_for_render:
-                print("RENDER!")
-                # Reload textures:
-                for img in bpy.data.images:
-                    img.reload()
-
-                # Basic parameters
-                scene = bpy.data.scenes['Scene']
-                render = scene.render
-
-                # Resolution change
-                render.resolution_x = self.sd_tool.resolution_x
-                render.resolution_y = self.sd_tool.resolution_y
-
-                bpy.context.scene.camera.location = self.t.camera_location
-
-                bpy.ops.render.render()
-                self.t.waiting_for_render = False
-                self.progress = 0.0
-            if self.t.waiting_for_refresh:
-                for img in bpy.data.images:
-                    img.reload()
-                self.t.waiting_for_refresh = False
+        if event.type != 'TIMER' or self.t is None:
             return {'PASS_THROUGH'}
+
+        # Messages put by the thread before it ended are all in the queue already
+        alive = self.t.is_alive()
+        # Progress of the denoising steps reported by the server
+        bpy.context.window_manager.progress_update(100 * self.t.progress)
+        while True:
+            try:
+                kind, value = self.t.messages.get_nowait()
+            except queue.Empty:
+                break
+            self.handle_message(kind, value)
+        if alive:
+            return {'PASS_THROUGH'}
+
         print("END")
-        time.sleep(1)
-        for img in bpy.data.images:
-            img.reload()
+        context.window_manager.event_timer_remove(self._timer)
+        bpy.context.window_manager.progress_end()
+        if self.t.error:
+            self.report({"ERROR"}, self.t.error)
+        elif self.t.timings:
+            timings = sorted(self.t.timings.items(), key=lambda item: item[1], reverse=True)
+            self.report({"INFO"}, "Server time: " + ", ".join(F"{name} {stage_time:.1f}s"
+                                                              for name, stage_time in timings))
         return {'FINISHED'}
 
+    def handle_message(self, kind, value):
+        if kind == "render":
+            self.render(value)
+        elif kind == "texture":
+            # The generated texture lives on the server until it is finished, use its latest pixels
+            set_image_pixels(bpy.data.images[self.output_image_name], value)
+        elif kind == "reload":
+            # Only the image of the material, written by the finishing step
+            bpy.data.images[self.output_image_name].reload()
+        elif kind == "preview":
+            preview_image = bpy.data.images.get(PREVIEW_IMAGE_NAME)
+            if preview_image is None:
+                preview_image = bpy.data.images.new(PREVIEW_IMAGE_NAME, width=value.shape[1], height=value.shape[0])
+            set_image_pixels(preview_image, value)
+
+    def render(self, camera_location):
+        print("RENDER!")
+        passes = None
+        try:
+            passes = render_passes(camera_location, self.sd_tool.resolution_x, self.sd_tool.resolution_y,
+                                   self.tmp_path, self.frame_code)
+        finally:
+            # The thread waits for the passes, None ends it with an error
+            self.t.rendered.put(passes)
+
     def cancel(self, context):
-        self.t.stop = True
+        self.t.cancel_job()
         wm = context.window_manager
         wm.event_timer_remove(self._timer)
+        wm.progress_end()
 
     def invoke(self, context, event):
         print("Invoked")
-        self.progress = 0.0
         scene = context.scene
         self.sd_tool = scene.sd_txt_tool
 
@@ -407,6 +837,7 @@ class WM_OT_GenerateTxt(Operator):
             self.report({"ERROR"}, F"Output directory '{self.out_path}' is not correct")
             return {'CANCELLED'}
 
+        self.frame_code = "{0:0>4}".format(bpy.context.scene.frame_current)
         self.tmp_path = self.out_path / "tmp"
         self.result_path = self.out_path / "result"
         self.tmp_path.mkdir(exist_ok=True)
@@ -418,9 +849,13 @@ class WM_OT_GenerateTxt(Operator):
             self.txt_path = self.sd_tool.out_txt
 
         self.api_url = F"http://{self.sd_tool.host}:{self.sd_tool.port}"
+        client = SDClient(self.api_url)
         try:
-            requests.get(self.api_url + "/status", json={}, timeout=1)
-        except (ConnectionError, requests.exceptions.ConnectTimeout, requests.exceptions.Timeout):
+            status = client.status(deadline=1)
+        except (RuntimeError, requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+            if PROCESS_CACHE is not None and PROCESS_CACHE.poll() is None:
+                self.report({"ERROR"}, "The SD server is still starting, please try again in a moment.")
+                return {'CANCELLED'}
             self.report({"ERROR"},
                         F"""Port {self.sd_tool.port} of host {self.sd_tool.host} is not opened.
 Start the Stable Diffusion server by:
@@ -428,8 +863,14 @@ Start the Stable Diffusion server by:
 - SD Server Settings >> Run SD Server
 Tf the server is running, make sure, that port and host of SD server are correct.""")
             return {'CANCELLED'}
-        except requests.exceptions.ConnectTimeout:
-            pass
+        finally:
+            # The generation thread opens its own client, the connection of this check is not kept
+            client.close()
+        if status.get("state") == "error":
+            self.report({"ERROR"}, F"The SD server could not load the model: {status.get('error')}")
+            return {'CANCELLED'}
+        if status.get("state") == "loading":
+            self.report({"INFO"}, "The SD server is still loading the model, generation starts when it is ready.")
 
         bpy.context.window_manager.progress_begin(0, 100)
         bpy.context.window_manager.progress_update(0)
@@ -438,26 +879,29 @@ Tf the server is running, make sure, that port and host of SD server are correct
 
         bpy.context.window_manager.progress_update(0)
 
-        bpy.ops.object.camera_add(enter_editmode=False)
-        camera = bpy.context.object
-        bpy.context.scene.camera = camera
-
-        # Add a new track to constraint and set it to track your object
-        track_to = bpy.context.object.constraints.new('TRACK_TO')
-        track_to.target = self.sd_tool.target
-        track_to.track_axis = 'TRACK_NEGATIVE_Z'
-        track_to.up_axis = 'UP_Y'
+        camera = add_camera(self.sd_tool.target)
+        mesh = None
+        camera_settings = None
+        if self.sd_tool.server_render:
+            mesh = mesh_arrays(self.sd_tool.target)
+            camera_settings = server_camera(camera, self.sd_tool.target,
+                                            self.sd_tool.resolution_x, self.sd_tool.resolution_y)
 
         self.t_cache.append(self.t)
         self.t = SDProcessor(data=self.generate_data(),
                              api_url=self.api_url,
-                             resolution_x=self.sd_tool.resolution_x, resolution_y=self.sd_tool.resolution_y,
                              camera_r=self.sd_tool.camera_r, camera_z=self.sd_tool.camera_z,
-                             wm=bpy.context.window_manager,
                              views_num=self.sd_tool.views_num,
-                             camera=camera)
+                             batch_views=self.sd_tool.batch_views,
+                             max_batch_size=self.sd_tool.max_batch_size,
+                             pipeline_views=self.sd_tool.pipeline_views,
+                             mesh=mesh,
+                             server_camera=camera_settings,
+                             scene_key=scene_key(self.sd_tool.target, camera,
+                                                 self.sd_tool.resolution_x, self.sd_tool.resolution_y))
 
         self.t.start()
-        self._timer = bpy.context.window_manager.event_timer_add(1, window=context.window)
+        # Only drains the messages of the thread, renders start at most one interval after they are requested
+        self._timer = bpy.context.window_manager.event_timer_add(MESSAGE_INTERVAL, window=context.window)
         context.window_manager.modal_handler_add(self)
         return {'RUNNING_MODAL'}
@@ -0,0 +1,55 @@
+import numpy as np
+
+# Vectorized triangle rasterizer. Triangles with the same bounding box size are drawn together: every texel
+# of their boxes is tested against the edge functions at once, in chunks of at most MAX_CANDIDATES texels.
+MAX_CANDIDATES = 2 ** 22
+
+
+def _edge(p0x, p0y, p1x, p1y, px, py):
+    return (p1x - p0x) * (py - p0y) - (p1y - p0y) * (px - p0x)
+
+
+def rasterize_triangles(shape, vertices):
+    # vertices is an (n, 3, 2) array of (x, y) positions. Texel (row, col) covers [col, col + 1) x [row, row + 1)
+    # and is drawn when its centre is inside a triangle or on its edge, so texels on a shared edge are returned
+    # for both triangles. Returns the flat index of every drawn texel of a (height, width) texture,
+    # the triangle it was drawn by and its barycentric coordinates in that triangle.
+    height, width = shape[:2]
+    vertices = np.asarray(vertices, dtype=np.float64)
+    ax, ay = vertices[:, 0, 0], vertices[:, 0, 1]
+    bx, by = vertices[:, 1, 0], vertices[:, 1, 1]
+    cx, cy = vertices[:, 2, 0], vertices[:, 2, 1]
+    area = _edge(ax, ay, bx, by, cx, cy)
+
+    # Range of the texel centres inside the bounding box of every triangle
+    first = np.maximum(np.ceil(vertices.min(axis=1) - 0.5), 0).astype(np.int64)
+    last = np.minimum(np.floor(vertices.max(axis=1) - 0.5), [width - 1, height - 1]).astype(np.int64)
+    size = last - first + 1
+    drawn = np.flatnonzero((np.abs(area) > 1e-12) & (size > 0).all(axis=1))
+
+    texels, triangles, barycentric = [], [], []
+    group_key = size[drawn, 1] * (width + 1) + size[drawn, 0]
+    order = np.argsort(group_key, kind="stable")
+    keys, starts = np.unique(group_key[order], return_index=True)
+    for key, start, stop in zip(keys, starts, list(starts[1:]) + [len(order)]):
+        box_h, box_w = divmod(int(key), width + 1)
+        offset_y, offset_x = np.divmod(np.arange(box_h * box_w), box_w)
+        chunk = max(MAX_CANDIDATES // (box_h * box_w), 1)
+        group = drawn[order[start:stop]]
+        for chunk_start in range(0, len(group), chunk):
+            tri = group[chunk_start:chunk_start + chunk, np.newaxis]
+            col = first[tri, 0] + offset_x
+            row = first[tri, 1] + offset_y
+            px = col + 0.5
+            py = row + 0.5
+            w_a = _edge(bx[tri], by[tri], cx[tri], cy[tri], px, py) / area[tri]
+            w_b = _edge(cx[tri], cy[tri], ax[tri], ay[tri], px, py) / area[tri]
+            w_c = 1 - w_a - w_b
+            inside = (w_a >= -1e-9) & (w_b >= -1e-9) & (w_c >= -1e-9)
+            texels.append(row[inside] * width + col[inside])
+            triangles.append(np.broadcast_to(tri, inside.shape)[inside])
+            barycentric.append(np.stack([w_a[inside], w_b[inside], w_c[inside]], axis=-1))
+
+    if not texels:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty((0, 3), dtype=np.float64)
+    return np.concatenate(texels), np.concatenate(triangles), np.clip(np.concatenate(barycentric), 0, 1)
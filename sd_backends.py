@@ -0,0 +1,356 @@
+import collections
+import hashlib
+import json
+import os
+import pathlib
+import time
+import uuid
+
+import numpy as np
+from PIL import Image
+
+
+class JobCancelled(Exception):
+    pass
+
+
+# Linear approximation of the VAE decoder of Stable Diffusion 1.x and 2.x, from the 4 latent channels to RGB.
+# Good enough for previews and far cheaper than decoding the latents.
+LATENT_RGB_FACTORS = [
+    [0.298, 0.207, 0.208],
+    [0.187, 0.286, 0.173],
+    [-0.158, 0.189, 0.264],
+    [-0.184, -0.271, -0.473],
+]
+
+
+def latents_to_rgb(latents):
+    import torch
+
+    factors = torch.tensor(LATENT_RGB_FACTORS, dtype=torch.float32, device=latents.device)
+    rgb = latents[0].float().permute(1, 2, 0) @ factors
+    return ((rgb.clamp(-1, 1) + 1) * 127.5).to(torch.uint8).cpu().numpy()
+
+
+class DiffusersBackend:
+    name = "diffusers"
+
+    def __init__(self, model_id="stabilityai/stable-diffusion-2-depth", dtype="auto", device="auto",
+                 snapshot_dir=None, prompt_cache_size=32):
+        self.model_id = model_id
+        self.dtype = dtype
+        self.device = device
+        self.snapshot_dir = snapshot_dir
+        self.pipe = None
+        # Text encoder outputs of recent (prompt, negative prompt) pairs, least recently used first
+        self.prompt_cache = collections.OrderedDict()
+        self.prompt_cache_size = prompt_cache_size
+        self.prompt_cache_hits = 0
+        self.prompt_cache_misses = 0
+
+    def load(self):
+        # torch and diffusers are only needed by this backend, the stub runs without them
+        import torch
+        from diffusers import StableDiffusionDepth2ImgPipeline
+
+        if self.device == "auto":
+            self.device = "cuda" if torch.cuda.is_available() else "cpu"
+        if self.dtype == "auto":
+            # Half precision is not supported by most of the CPU kernels
+            self.dtype = "float32" if self.device == "cpu" else "float16"
+        torch_dtype = getattr(torch, self.dtype)
+
+        snapshot = pathlib.Path(self.snapshot_dir) if self.snapshot_dir else None
+        if snapshot is not None and (snapshot / "model_index.json").exists():
+            print(F"Loading {self.model_id} from the local snapshot {snapshot}")
+            pipe = StableDiffusionDepth2ImgPipeline.from_pretrained(snapshot, torch_dtype=torch_dtype,
+                                                                    local_files_only=True)
+        else:
+            pipe = StableDiffusionDepth2ImgPipeline.from_pretrained(self.model_id, torch_dtype=torch_dtype)
+            if snapshot is not None:
+                # Next start reads the weights from a single local directory, without resolving the hub cache
+                pipe.save_pretrained(snapshot)
+        self.pipe = pipe.to(self.device)
+
+    def encode_prompt(self, prompt, n_prompt):
+        import torch
+
+        key = (self.model_id, prompt, n_prompt)
+        if key in self.prompt_cache:
+            self.prompt_cache.move_to_end(key)
+            self.prompt_cache_hits += 1
+            return self.prompt_cache[key]
+
+        self.prompt_cache_misses += 1
+        with torch.no_grad():
+            # guidance_scale is above 1, so the pipeline needs the negative embeddings too
+            embeds = self.pipe.encode_prompt(prompt, self.device, num_images_per_prompt=1,
+                                             do_classifier_free_guidance=True, negative_prompt=n_prompt)
+        if self.prompt_cache_size > 0:
+            self.prompt_cache[key] = embeds
+            while len(self.prompt_cache) > self.prompt_cache_size:
+                self.prompt_cache.popitem(last=False)
+        return embeds
+
+    def generate(self, data, inputs, max_batch_size=1, cancelled=None, progress=None):
+        import torch
+
+        preview_steps = int(data.get("preview_steps") or 0)
+
+        def on_step_end(pipe, step, timestep, callback_kwargs):
+            # Called by the pipeline after every denoising step, the exception unwinds the whole call
+            if cancelled is not None and cancelled.is_set():
+                raise JobCancelled()
+            if progress is not None:
+                steps = pipe.num_timesteps
+                preview = None
+                if preview_steps and ((step + 1) % preview_steps == 0 or step + 1 == steps):
+                    preview = latents_to_rgb(callback_kwargs["latents"])
+                progress(step + 1, steps, (len(images) + len(batch) * (step + 1) / steps) / len(inputs), preview)
+            return callback_kwargs
+
+        prompt = data.get("prompt")
+        n_prompt = data.get("n_prompt", "")
+        num_inference_steps = data.get("steps")
+        seed = data.get("seed", 1024)
+        prompt_embeds, negative_prompt_embeds = self.encode_prompt(prompt, n_prompt)
+
+        images = []
+        while len(images) < len(inputs):
+            batch = inputs[len(images):len(images) + max_batch_size]
+            # One generator per view, so every view gets the same noise as when it is generated on its own
+            generators = [torch.Generator(device=self.device).manual_seed(seed) for _ in batch]
+            depth_arr = torch.from_numpy(np.stack([view_input["depth_map"] for view_input in batch]))
+            try:
+                result = self.pipe(prompt_embeds=prompt_embeds.repeat(len(batch), 1, 1),
+                                   negative_prompt_embeds=negative_prompt_embeds.repeat(len(batch), 1, 1),
+                                   image=[view_input["image"] for view_input in batch],
+                                   depth_map=depth_arr, guidance_scale=9, strength=0.8, generator=generators,
+                                   num_inference_steps=num_inference_steps, num_images_per_prompt=1,
+                                   callback_on_step_end=on_step_end)
+            except torch.cuda.OutOfMemoryError:
+                if max_batch_size == 1:
+                    raise
+                torch.cuda.empty_cache()
+                max_batch_size = max(max_batch_size // 2, 1)
+                print(F"Out of GPU memory, retrying with batches of {max_batch_size} views")
+                continue
+            images += result.images
+        return images
+
+    def reset_peak_memory(self):
+        import torch
+
+        if str(self.device).startswith("cuda"):
+            torch.cuda.reset_peak_memory_stats(self.device)
+
+    def free_memory(self):
+        import torch
+
+        if str(self.device).startswith("cuda"):
+            torch.cuda.empty_cache()
+
+    def memory_stats(self):
+        import torch
+
+        if not str(self.device).startswith("cuda"):
+            return None
+        return {
+            "allocated_mb": torch.cuda.memory_allocated(self.device) / 2 ** 20,
+            "reserved_mb": torch.cuda.memory_reserved(self.device) / 2 ** 20,
+            "peak_mb": torch.cuda.max_memory_allocated(self.device) / 2 ** 20,
+        }
+
+    def stats(self):
+        return {
+            "prompt_cache": {
+                "hits": self.prompt_cache_hits,
+                "misses": self.prompt_cache_misses,
+                "size": len(self.prompt_cache),
+                "capacity": self.prompt_cache_size,
+            },
+        }
+
+    def to_dict(self):
+        return {"backend": self.name, "model": self.model_id, "dtype": self.dtype, "device": self.device}
+
+
+# Deterministic CPU backend for load tests and for the texture pipeline without a GPU,
+# the colour of a view depends only on its depth and the seed.
+class StubBackend:
+    name = "stub"
+
+    def __init__(self, step_time=0.0):
+        # Optional sleep per inference step, to emulate the latency of a real model
+        self.step_time = step_time
+
+    def load(self):
+        pass
+
+    def generate(self, data, inputs, max_batch_size=1, cancelled=None, progress=None):
+        seed = int(data.get("seed", 1024))
+        steps = int(data.get("steps") or 1)
+        preview_steps = int(data.get("preview_steps") or 0)
+        color = np.random.default_rng(seed).integers(64, 256, size=3).astype(np.float32)
+
+        images = []
+        for view_input in inputs:
+            depth_arr = view_input["depth_map"].astype(np.float32)
+            depth_range = max(float(depth_arr.max() - depth_arr.min()), 1e-6)
+            shade = 0.5 + 0.5 * (depth_arr - depth_arr.min()) / depth_range
+            img_arr = (shade[..., np.newaxis] * color).astype(np.uint8)
+            images.append(Image.fromarray(img_arr, 'RGB').resize(view_input["image"].size))
+        for batch_start in range(0, len(inputs), max_batch_size):
+            batch = len(inputs[batch_start:batch_start + max_batch_size])
+            for step in range(steps):
+                if cancelled is not None and cancelled.is_set():
+                    raise JobCancelled()
+                time.sleep(self.step_time)
+                if progress is not None:
+                    preview = None
+                    if preview_steps and ((step + 1) % preview_steps == 0 or step + 1 == steps):
+                        # Fades in from gray like a denoised image, at the latent resolution of the real model
+                        latent = np.asarray(images[batch_start].reduce(8), dtype=np.float32)
+                        preview = (128 + (latent - 128) * (step + 1) / steps).astype(np.uint8)
+                    progress(step + 1, steps, (batch_start + batch * (step + 1) / steps) / len(inputs), preview)
+        return images
+
+    def reset_peak_memory(self):
+        pass
+
+    def free_memory(self):
+        pass
+
+    def memory_stats(self):
+        return None
+
+    def stats(self):
+        return {}
+
+    def to_dict(self):
+        return {"backend": self.name, "model": None, "dtype": "uint8", "device": "cpu"}
+
+
+class ResultCache:
+    # Generated images addressed by a hash of everything the model sees: the prepared image and depth map
+    # of a view, the prompts, seed and steps and the model itself. Recent results stay in memory, all of them
+    # in an optional directory shared by the workers, trimmed to max_disk_mb by removing the oldest files.
+    version = 1
+
+    def __init__(self, memory_size=64, directory=None, max_disk_mb=2048):
+        self.memory = collections.OrderedDict()
+        self.memory_size = memory_size
+        self.directory = pathlib.Path(directory) if directory else None
+        self.max_disk_bytes = max_disk_mb * 2 ** 20
+        self.hits = 0
+        self.misses = 0
+        if self.directory is not None:
+            self.directory.mkdir(parents=True, exist_ok=True)
+
+    def key(self, backend, data, view_input):
+        params = {
+            "version": self.version,
+            "backend": {name: value for name, value in backend.to_dict().items() if name != "device"},
+            "prompt": data.get("prompt"),
+            "n_prompt": data.get("n_prompt", ""),
+            "seed": data.get("seed", 1024),
+            "steps": data.get("steps"),
+        }
+        digest = hashlib.sha256(bytes(json.dumps(params, sort_keys=True), "utf8"))
+        image_arr = np.asarray(view_input["image"])
+        for arr in (image_arr, view_input["depth_map"]):
+            digest.update(bytes(F"{arr.dtype.str}{arr.shape}", "utf8"))
+            digest.update(np.ascontiguousarray(arr).data)
+        return digest.hexdigest()
+
+    def get(self, key):
+        if key in self.memory:
+            self.memory.move_to_end(key)
+            self.hits += 1
+            return self.memory[key]
+        if self.directory is not None:
+            path = self.directory / F"{key}.png"
+            try:
+                with Image.open(path) as img:
+                    img = img.convert("RGB")
+                os.utime(path)
+                self.hits += 1
+                self.remember(key, img)
+                return img
+            except (FileNotFoundError, OSError):
+                pass
+        self.misses += 1
+        return None
+
+    def remember(self, key, img):
+        if self.memory_size <= 0:
+            return
+        self.memory[key] = img
+        while len(self.memory) > self.memory_size:
+            self.memory.popitem(last=False)
+
+    def put(self, key, img):
+        self.remember(key, img)
+        if self.directory is None:
+            return
+        # Written under a temporary name first, other workers never read a partial file
+        tmp_path = self.directory / F"{key}.{uuid.uuid4().hex}.tmp"
+        img.save(tmp_path, format="PNG")
+        os.replace(tmp_path, self.directory / F"{key}.png")
+        self.trim()
+
+    def trim(self):
+        files = []
+        for path in self.directory.glob("*.png"):
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= self.max_disk_bytes:
+                break
+            try:
+                path.unlink()
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "memory_size": len(self.memory)}
+
+
+class CachedBackend:
+    # Wraps a backend, only views without a cached result are sent to the model
+    def __init__(self, backend, cache):
+        self.backend = backend
+        self.cache = cache
+
+    def __getattr__(self, name):
+        return getattr(self.backend, name)
+
+    def generate(self, data, inputs, max_batch_size=1, cancelled=None, progress=None):
+        keys = [self.cache.key(self.backend, data, view_input) for view_input in inputs]
+        images = [self.cache.get(key) for key in keys]
+        missing = [num for num, img in enumerate(images) if img is None]
+        if missing:
+            generated = self.backend.generate(data, [inputs[num] for num in missing], max_batch_size, cancelled,
+                                              progress)
+            for num, img in zip(missing, generated):
+                self.cache.put(keys[num], img)
+                images[num] = img
+        return images
+
+    def stats(self):
+        return dict(self.backend.stats(), result_cache=self.cache.stats())
+
+
+BACKENDS = {
+    DiffusersBackend.name: DiffusersBackend,
+    StubBackend.name: StubBackend,
+}
+
+
+def create_backend(name, **options):
+    return BACKENDS[name](**options)
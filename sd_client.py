@@ -0,0 +1,157 @@
+import base64
+import json
+import random
+import time
+
+import numpy as np
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
+
+from .sd_transport import CONTENT_TYPE as TRANSPORT_CONTENT_TYPE, pack_arrays, unpack_arrays
+
+# Responses of a server that is starting or overloaded, worth another try
+RETRY_STATUS = (502, 503, 504)
+FINISHED_STATES = ("done", "error", "cancelled")
+
+
+class ServerError(RuntimeError):
+    def __init__(self, path, status_code, message):
+        super().__init__(F"Request {path} rejected by the server ({status_code}): {message}")
+        self.status_code = status_code
+
+
+def never_sent(error):
+    # Only a connection that could not be opened proves the server never got the request
+    if isinstance(error, requests.exceptions.ConnectTimeout):
+        return True
+    return bool(error.args) and isinstance(getattr(error.args[0], "reason", None), NewConnectionError)
+
+
+class SDClient:
+    # Every call of the add-on to the SD server goes through one requests session, so connections are kept
+    # alive and reused. Failed connections and timeouts are retried with exponential backoff and jitter until
+    # the deadline of the call. Requests that start a job or a session are not idempotent, they are only
+    # retried when the connection could not be opened (refused or timed out). A connection dropped or timed
+    # out after the request was sent is raised, the server may already run it.
+    def __init__(self, api_url, timeout=10, deadline=60, backoff=0.25, max_backoff=4.0):
+        self.api_url = api_url
+        self.timeout = timeout
+        self.deadline = deadline
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.session = requests.Session()
+        self.session.mount("http://", HTTPAdapter(pool_connections=1, pool_maxsize=4))
+
+    def close(self):
+        self.session.close()
+
+    def request(self, path, json_data=None, body=None, timeout=None, deadline=None, idempotent=True, stream=False):
+        deadline = self.deadline if deadline is None else deadline
+        started_at = time.monotonic()
+        headers = {"Content-Type": TRANSPORT_CONTENT_TYPE} if body is not None else None
+        attempt = 0
+        while True:
+            try:
+                response = self.session.get(self.api_url + path, json=json_data, data=body, headers=headers,
+                                            timeout=timeout or self.timeout, stream=stream)
+                if response.status_code not in RETRY_STATUS:
+                    return response
+                error = ServerError(path, response.status_code, response.text)
+                response.close()
+            except requests.exceptions.ConnectionError as e:
+                if not idempotent and not never_sent(e):
+                    raise
+                error = e
+            except requests.exceptions.Timeout as e:
+                if not idempotent:
+                    raise
+                error = e
+            delay = min(self.backoff * 2 ** attempt, self.max_backoff) * random.uniform(0.5, 1.0)
+            if time.monotonic() - started_at + delay > deadline:
+                raise error
+            time.sleep(delay)
+            attempt += 1
+
+    def get_json(self, path, json_data=None, **kwargs):
+        response = self.request(path, json_data if json_data is not None else {}, **kwargs)
+        if response.status_code != 200:
+            raise ServerError(path, response.status_code, response.text)
+        return response.json()
+
+    def get_arrays(self, path, json_data, **kwargs):
+        response = self.request(path, json_data, **kwargs)
+        if response.status_code != 200:
+            raise ServerError(path, response.status_code, response.text)
+        return unpack_arrays(response.content)
+
+    def status(self, deadline=None):
+        return self.get_json("/status", deadline=deadline, timeout=2)
+
+    def submit_job(self, path, data):
+        return self.get_json(path, data, idempotent=False)["job_id"]
+
+    def submit_arrays(self, path, data, arrays):
+        response = self.request(path, body=pack_arrays(data, arrays), timeout=60, idempotent=False)
+        if response.status_code != 200:
+            raise ServerError(path, response.status_code, response.text)
+        return response.json()["job_id"]
+
+    def job(self, job_id):
+        return self.get_json(F"/jobs/{job_id}")
+
+    def job_result(self, job_id):
+        # Arrays returned by a finished job, the server sends them only once
+        _, arrays = self.get_arrays(F"/jobs/{job_id}/result", {}, timeout=60)
+        return arrays
+
+    def cancel_job(self, job_id):
+        return self.get_json(F"/jobs/{job_id}/cancel", timeout=2, deadline=5)
+
+    def job_events(self, job_id, idle_timeout=60):
+        # Yields the server-sent events of a job as (event, payload) until the job is finished. The events carry
+        # the whole state of the job, so a dropped stream is opened again and continues where it was.
+        while True:
+            response = self.request(F"/jobs/{job_id}/events", timeout=(self.timeout, idle_timeout), stream=True)
+            if response.status_code != 200:
+                raise ServerError(F"/jobs/{job_id}/events", response.status_code, response.text)
+            event = None
+            try:
+                with response:
+                    for line in response.iter_lines(decode_unicode=True):
+                        if line.startswith("event: "):
+                            event = line[len("event: "):]
+                        elif line.startswith("data: "):
+                            payload = json.loads(line[len("data: "):])
+                            yield event, payload
+                            if event == "job" and payload["state"] in FINISHED_STATES:
+                                return
+            except (requests.exceptions.ConnectionError, requests.exceptions.ChunkedEncodingError):
+                pass
+
+    def create_session(self, data):
+        return self.get_json("/session/create", data, timeout=60, idempotent=False)["session_id"]
+
+    def discard_session(self, session_id):
+        return self.get_json("/session/discard", {"session_id": session_id}, deadline=10)
+
+    def upload_mesh(self, session_id, arrays):
+        # Mesh of the views rendered by the server, arrays as in mesh_render.Mesh
+        path = "/session/mesh"
+        response = self.request(path, body=pack_arrays({"session_id": session_id}, arrays), timeout=60)
+        if response.status_code != 200:
+            raise ServerError(path, response.status_code, response.text)
+        return response.json()
+
+    def render_view(self, session_id, camera):
+        _, arrays = self.get_arrays("/session/render", {"session_id": session_id, "camera": camera}, timeout=60)
+        return arrays
+
+    def texture(self, session_id, max_size=None):
+        _, arrays = self.get_arrays("/texture", {"session_id": session_id, "max_size": max_size}, timeout=60)
+        return arrays["texture"]
+
+
+def decode_preview(payload):
+    pixels = np.frombuffer(base64.b64decode(payload["data"]), dtype=np.uint8)
+    return pixels.reshape(payload["shape"])
@@ -0,0 +1,38 @@
+import json
+import struct
+
+import numpy as np
+
+# Binary payload used to send render passes and textures without going through image files:
+# a little-endian uint32 with the length of a JSON header, the header itself and the raw array buffers.
+# The header holds the request parameters and the name, dtype, shape and offset of every array.
+HEADER_LENGTH = struct.Struct("<I")
+CONTENT_TYPE = "application/octet-stream"
+
+
+def pack_arrays(params, arrays):
+    entries = []
+    buffers = []
+    offset = 0
+    for name, arr in arrays.items():
+        arr = np.ascontiguousarray(arr)
+        entries.append({"name": name, "dtype": arr.dtype.str, "shape": list(arr.shape), "offset": offset})
+        buffers.append(arr.reshape(-1).view(np.uint8).data)
+        offset += arr.nbytes
+    header = bytes(json.dumps({"params": params, "arrays": entries}), "utf8")
+    return b"".join([HEADER_LENGTH.pack(len(header)), header] + buffers)
+
+
+def unpack_arrays(body):
+    if len(body) < HEADER_LENGTH.size:
+        raise ValueError("Payload shorter than its header length")
+    header_length, = HEADER_LENGTH.unpack_from(body, 0)
+    header = json.loads(str(body[HEADER_LENGTH.size:HEADER_LENGTH.size + header_length], "utf8"))
+    data_start = HEADER_LENGTH.size + header_length
+    arrays = dict()
+    for entry in header["arrays"]:
+        dtype = np.dtype(entry["dtype"])
+        count = int(np.prod(entry["shape"], dtype=np.int64))
+        arr = np.frombuffer(body, dtype=dtype, count=count, offset=data_start + entry["offset"])
+        arrays[entry["name"]] = arr.reshape(entry["shape"])
+    return header["params"], arrays
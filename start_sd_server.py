@@ -1,183 +1,1540 @@
 import pathlib
+import tempfile
+import threading
 import time
-from http.server import BaseHTTPRequestHandler, HTTPServer
+import traceback
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import argparse
+import base64
+import contextlib
+import collections
+import copy
 import json
-import torch
-from diffusers import StableDiffusionDepth2ImgPipeline
+import multiprocessing
+import multiprocessing.connection
 from PIL import Image, ImageChops
 import numpy as np
 import cv2
 import os
 
+from mesh_render import Mesh, camera_view_key, render_mesh_passes
+from rasterizer import rasterize_triangles
+from sd_backends import BACKENDS, CachedBackend, JobCancelled, ResultCache, create_backend
+from sd_transport import CONTENT_TYPE as TRANSPORT_CONTENT_TYPE, pack_arrays, unpack_arrays
+
+
+def _empty_texels(arr):
+    if np.issubdtype(arr.dtype, np.integer):
+        any_channel = arr[..., 0] != 0
+        for channel in range(1, arr.shape[-1]):
+            any_channel |= arr[..., channel] != 0
+        return ~any_channel, any_channel
+    color_sum = arr.sum(axis=-1, dtype=np.float64)
+    return color_sum < 0.00001, color_sum > 0.00001
+
+
+def _fill_gaps_along_lines(flat, empty, valid, axis, line_start, step, partial):
+    # Same result as sweeping every line from its start to its end and giving an empty texel the average of its
+    # non-empty previous/next neighbours. Texels filled by the sweep are the previous neighbour of the next texel,
+    # so without `partial` a gap is flooded from its start and only its last texel mixes in the next side.
+    # Like the original loops, the previous neighbour of the first texel of a line is its last texel.
+    # Lines run along `axis` of the empty and valid masks of a band, texel i of line l is
+    # flat[line_start[l] + i * step]. The texels are filled in place: only empty ones are written, all from
+    # texels that were not empty, so only the empty texels are gathered and the order of the writes does not matter.
+    length = empty.shape[axis]
+    # Distance between neighbours of a line in the flattened masks
+    mask_step = 1 if axis == 1 else empty.shape[1]
+    index_dtype = np.int32 if len(flat) < 2 ** 31 else np.int64
+    if partial:
+        # Only empty texels with two non-empty neighbours are filled, nothing is flooded. The neighbours are
+        # the masks of the band shifted by one texel along the lines, no gap has to be followed.
+        line_empty, line_valid = (empty, valid) if axis == 1 else (empty.T, valid.T)
+        mixed = np.zeros_like(empty)
+        line_mixed = mixed if axis == 1 else mixed.T
+        if length > 1:
+            np.logical_and(line_valid[:, :-2], line_valid[:, 2:], out=line_mixed[:, 1:-1])
+            np.logical_and(line_valid[:, -1], line_valid[:, 1], out=line_mixed[:, 0])
+            line_mixed &= line_empty
+        targets = np.flatnonzero(mixed).astype(index_dtype)
+        del mixed, line_mixed
+        if axis == 1:
+            line, pos = np.divmod(targets, length)
+        else:
+            pos, line = np.divmod(targets, mask_step)
+        prev_pos = np.where(pos == 0, length - 1, pos - 1).astype(index_dtype)
+        # All of them mix their two neighbours
+        mixed = slice(None)
+    else:
+        positions = np.arange(length, dtype=index_dtype)
+        last_filled = np.where(empty, -1, positions if axis == 1 else positions[:, np.newaxis])
+        np.maximum.accumulate(last_filled, axis=axis, out=last_filled)
+        last_filled = last_filled.reshape(-1)
+        empty = empty.reshape(-1)
+        valid = valid.reshape(-1)
+
+        targets = np.flatnonzero(empty).astype(index_dtype)
+        if axis == 1:
+            line, pos = np.divmod(targets, length)
+        else:
+            pos, line = np.divmod(targets, mask_step)
+        first = pos == 0
+        last = pos == length - 1
+        prev_pos = np.where(first, -1, last_filled[targets - mask_step])
+        prev_pos[prev_pos < 0] = length - 1
+        after = np.minimum(targets + mask_step, len(empty) - 1)
+        prev_valid = valid[targets + (prev_pos - pos) * mask_step]
+        next_valid = valid[after] & ~last
+        gap_end = ~empty[after] | last
+        mixed = gap_end & prev_valid & next_valid
+        filled = prev_valid | (gap_end & next_valid)
+        del last_filled, after, last, first
+
+    start = np.asarray(line_start, dtype=index_dtype)[line]
+    targets = start + pos * step
+    prev_idx = start + prev_pos * step
+    next_idx = targets + step
+    del line, start, pos, prev_pos
+    if not partial:
+        src_idx = np.where(prev_valid, prev_idx, next_idx)[filled]
+        flat[targets[filled]] = np.take(flat, src_idx, axis=0)
+
+    prev = np.take(flat, prev_idx[mixed], axis=0)
+    following = np.take(flat, next_idx[mixed], axis=0)
+    if np.issubdtype(flat.dtype, np.integer):
+        flat[targets[mixed]] = (prev.astype(np.int64) + following) // 2
+    else:
+        flat[targets[mixed]] = (prev.astype(np.float64) + following) / 2.0
+
+
+# Large textures are processed in bands of about this many texels, to keep the temporary arrays small
+BAND_TEXELS = 2 ** 22
+
 
 def finish_texture(out_img_arr, partial=False):
-    for x in range(out_img_arr.shape[0]):
-        for y in range(out_img_arr.shape[1]):
-            color = out_img_arr[x][y]
-            if sum(color) < 0.00001:
-                number_of_colors = 0
-                out_color = np.array([0, 0, 0])
-                for x1, y1 in [[x, y - 1], [x, y + 1]]:
-                    if x1 >= out_img_arr.shape[0] or y1 >= out_img_arr.shape[1]:
-                        continue
-                    c = out_img_arr[x1][y1]
-                    if sum(c) > 0.00001:
-                        out_color += c
-                        number_of_colors += 1
-                if number_of_colors == 0 or (partial and number_of_colors < 2):
+    # Rows, and then columns, are filled independently of each other, so they can be processed in bands.
+    # Both passes index the texture through one flat view, columns are not copied out and back.
+    if not out_img_arr.flags.c_contiguous:
+        out_img_arr[...] = finish_texture(np.ascontiguousarray(out_img_arr), partial)
+        return out_img_arr
+    height, width, channels = out_img_arr.shape
+    flat = out_img_arr.reshape(-1, channels)
+    band_rows = max(BAND_TEXELS // width, 1)
+    for start in range(0, height, band_rows):
+        empty, valid = _empty_texels(out_img_arr[start:start + band_rows])
+        line_start = np.arange(start, start + len(empty), dtype=np.int64) * width
+        _fill_gaps_along_lines(flat, empty, valid, 1, line_start, 1, partial)
+    band_cols = max(BAND_TEXELS // height, 1)
+    for start in range(0, width, band_cols):
+        empty, valid = _empty_texels(out_img_arr[:, start:start + band_cols])
+        line_start = np.arange(start, start + empty.shape[1], dtype=np.int64)
+        _fill_gaps_along_lines(flat, empty, valid, 0, line_start, width, partial)
+    return out_img_arr
+
+
+def uv_texels(tex_shape, u, v):
+    # Row and column of the texel at UV coordinates as computed by the original loop, before wrapping
+    tex_h, tex_w = tex_shape[:2]
+    return (tex_w - 2) - (tex_w * v).astype(np.int64), (tex_h * u).astype(np.int64) - 1
+
+
+def scatter_view(tex_shape, uv_img_arr, alpha_arr):
+    # Finds the texel of every covered pixel of a rendered view through its UV coordinates.
+    # Returns flat pixel and texel indices in row-major pixel order. Texels are addressed like
+    # `out_img_arr[row, col]` in the original loop: negative indices wrap around and the ones
+    # outside of the texture are skipped.
+    tex_h, tex_w = tex_shape[:2]
+    u = uv_img_arr[..., 0]
+    v = uv_img_arr[..., 1]
+    covered = (alpha_arr > 244) & (u + v + uv_img_arr[..., 2] > 0.00000001)
+    src_idx = np.flatnonzero(covered)
+
+    rows, cols = uv_texels(tex_shape, u.reshape(-1)[src_idx], v.reshape(-1)[src_idx])
+    inside = (rows >= -tex_h) & (rows < tex_h) & (cols >= -tex_w) & (cols < tex_w)
+    return src_idx[inside], (rows[inside] % tex_h) * tex_w + cols[inside] % tex_w
+
+
+def depth_mix_factor(depth_arr, src_idx, src_weight=None):
+    depth = depth_arr[..., 0] if depth_arr.ndim == 3 else depth_arr
+    depth = depth.reshape(-1)[src_idx]
+    if src_weight is not None:
+        depth = (depth * src_weight).sum(axis=-1)
+    return (np.clip(depth / 255, 0, 0.5) * 2) ** 2
+
+
+# Texel index of a view: every covered pixel of the upscaled render, the texel it lands in and its weight
+# for depth based mixing. It only depends on the mesh, camera pose, render resolution and texture size.
+VIEW_INDEX_DTYPE = np.dtype([("src", "<i4"), ("texel", "<i4"), ("depth", "<f4")])
+
+
+def build_view_index(tex_shape, uv_img_arr, alpha_arr, depth_arr):
+    src_idx, targets = scatter_view(tex_shape, uv_img_arr, alpha_arr)
+    index = np.empty(len(src_idx), dtype=VIEW_INDEX_DTYPE)
+    index["src"] = src_idx
+    index["texel"] = targets
+    index["depth"] = depth_mix_factor(depth_arr, src_idx)
+    return index
+
+
+# Inverse mapping: the screen grid of a view is triangulated, two triangles per quad of covered pixels, and drawn
+# into the texture at its UV coordinates. Every drawn texel samples the generated image bilinearly at the screen
+# position it was drawn from, so the native resolution render covers the texture without gaps.
+# Quads stretched over more than MAX_UV_EDGE of the UV space cross a seam or a silhouette and are not drawn.
+INVERSE_VIEW_INDEX_DTYPE = np.dtype([("src", "<i4", (4,)), ("weight", "<f4", (4,)), ("texel", "<i4"),
+                                     ("depth", "<f4")])
+MAX_UV_EDGE = 0.05
+# Quads of covered pixels drawn at once, bounds the memory of the rasterized fragments
+INVERSE_BAND_QUADS = 2 ** 16
+PROJECTIONS = ("forward", "inverse")
+
+
+def _inverse_samples(tex_shape, uv_flat, corners):
+    # Texels drawn by the quads of corners in the shifted lattice, with the pixels and weights they sample
+    tex_h, tex_w = tex_shape[:2]
+    # The texel lattice of scatter_view, shifted by one texel, so its wrapped first row and column are drawn too
+    points = np.stack([uv_flat[:, 0] * tex_h, (1 - uv_flat[:, 1]) * tex_w], axis=-1)
+    triangles = np.concatenate([corners[:, [0, 1, 3]], corners[:, [0, 3, 2]]])
+    texels, tri, barycentric = rasterize_triangles((tex_h + 1, tex_w + 1), points[triangles])
+    texels, first = np.unique(texels, return_index=True)
+    tri, barycentric = tri[first], barycentric[first]
+
+    # Screen position of every texel relative to the top left pixel of its quad, the corners of the first
+    # triangle of a quad are (0, 0), (1, 0), (1, 1) and of the second one (0, 0), (1, 1), (0, 1)
+    first_half = tri < len(corners)
+    barycentric = barycentric.astype(np.float32)
+    fx = barycentric[:, 1] + np.where(first_half, barycentric[:, 2], 0)
+    fy = barycentric[:, 2] + np.where(first_half, 0, barycentric[:, 1])
+    src_weight = np.stack([(1 - fx) * (1 - fy), fx * (1 - fy), (1 - fx) * fy, fx * fy], axis=-1)
+    src_idx = corners.astype(np.int32)[tri % max(len(corners), 1)]
+    return texels, src_idx, src_weight
+
+
+def build_inverse_view_index(tex_shape, uv_img_arr, alpha_arr, depth_arr):
+    tex_h, tex_w = tex_shape[:2]
+    height, width = alpha_arr.shape[:2]
+    u = uv_img_arr[..., 0]
+    v = uv_img_arr[..., 1]
+    covered = (alpha_arr > 244) & (u + v + uv_img_arr[..., 2] > 0.00000001)
+
+    quad = covered[:-1, :-1] & covered[:-1, 1:] & covered[1:, :-1] & covered[1:, 1:]
+    quad_rows, quad_cols = np.nonzero(quad)
+    top_left = quad_rows * width + quad_cols
+    corners = np.stack([top_left, top_left + 1, top_left + width, top_left + width + 1], axis=-1)
+    uv_flat = uv_img_arr[..., :2].reshape(-1, 2).astype(np.float64)
+    corner_uv = uv_flat[corners]
+    stretch = corner_uv.max(axis=1) - corner_uv.min(axis=1)
+    corners = corners[(stretch <= MAX_UV_EDGE).all(axis=-1)]
+    del corner_uv, stretch
+
+    # Quads are drawn in bands of screen rows, so the fragments in memory at once do not grow with the render
+    parts = [_inverse_samples(tex_shape, uv_flat, corners[start:start + INVERSE_BAND_QUADS])
+             for start in range(0, len(corners), INVERSE_BAND_QUADS)]
+    if parts:
+        texels, src_idx, src_weight = (np.concatenate(arrays) for arrays in zip(*parts))
+    else:
+        texels = np.empty(0, dtype=np.int64)
+        src_idx = np.empty((0, 4), dtype=np.int32)
+        src_weight = np.empty((0, 4), dtype=np.float32)
+    del parts
+    # Texels on the border of two bands are drawn by both, the first band wins
+    texels, first = np.unique(texels, return_index=True)
+    src_idx, src_weight = src_idx[first], src_weight[first]
+    rows, cols = np.divmod(texels, tex_w + 1)
+    texels = ((rows - 1) % tex_h) * tex_w + (cols - 1) % tex_w
+
+    # Texels between pixels that are not part of a complete quad, e.g. on thin parts of the mesh,
+    # still get the pixel that lands in them
+    scatter_src, scatter_texels = scatter_view(tex_shape, uv_img_arr, alpha_arr)
+    missing = ~np.isin(scatter_texels, texels)
+    scatter_src, scatter_texels = scatter_src[missing], scatter_texels[missing]
+
+    index = np.empty(len(texels) + len(scatter_texels), dtype=INVERSE_VIEW_INDEX_DTYPE)
+    index["src"][:len(texels)] = src_idx
+    index["weight"][:len(texels)] = src_weight
+    index["src"][len(texels):] = scatter_src[:, np.newaxis]
+    index["weight"][len(texels):] = [1, 0, 0, 0]
+    index["texel"][:len(texels)] = texels
+    index["texel"][len(texels):] = scatter_texels
+    index["depth"] = depth_mix_factor(depth_arr, index["src"], index["weight"])
+    return index
+
+
+def sample_colors(img_arr, index):
+    img_flat = img_arr.reshape(-1, img_arr.shape[-1])
+    src_idx = np.asarray(index["src"])
+    if src_idx.ndim == 1:
+        return img_flat[src_idx, :3].astype(np.float32)
+    colors = img_flat[src_idx, :3].astype(np.float32)
+    return np.einsum("nk,nkc->nc", np.asarray(index["weight"]), colors)
+
+
+def project_view(out_img_arr, img_arr, uv_img_arr, alpha_arr, depth_arr, depth_based_mixing=False):
+    # Pixels are written in row-major order, so when several pixels land on the same texel the last one wins.
+    src_idx, targets = scatter_view(out_img_arr.shape, uv_img_arr, alpha_arr)
+    _, last = np.unique(targets[::-1], return_index=True)
+    keep = len(targets) - 1 - last
+    src_idx = src_idx[keep]
+    targets = targets[keep]
+
+    channels = out_img_arr.shape[-1]
+    out_flat = out_img_arr.reshape(-1, channels)
+    colors = img_arr.reshape(-1, img_arr.shape[-1])[src_idx, :channels]
+    _, has_color = _empty_texels(out_flat[targets])
+
+    if depth_based_mixing:
+        depth = depth_mix_factor(depth_arr, src_idx[has_color])[:, np.newaxis]
+        mixed = colors[has_color] * (1 - depth) + out_flat[targets[has_color]] * depth
+        colors = colors.copy()
+        colors[has_color] = mixed.astype(colors.dtype)
+        out_flat[targets] = colors
+    else:
+        out_flat[targets[~has_color]] = colors[~has_color]
+    return out_img_arr
+
+
+def file_mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except (OSError, TypeError, ValueError):
+        return None
+
+
+class TextureSession:
+    # Weight of the texels of the starting texture and the smallest weight of a generated sample.
+    # Samples seen at a grazing depth still fill texels that no other view covers.
+    prior_weight = 1.0
+    min_sample_weight = 0.001
+    # Textures with more texels keep their buffers in memory-mapped files in storage_dir (the system temporary
+    # directory by default), so the memory of the server does not grow with the texture size.
+    memmap_texels = 2048 * 2048
+    storage_dir = None
+
+    def __init__(self, out_txt_path, shape, session_id=None):
+        self.id = session_id or uuid.uuid4().hex
+        self.out_txt_path = out_txt_path
+        self.lock = threading.Lock()
+        self.files = []
+        self.weight = self.buffer(shape[:2], np.float32)
+        self.color = self.buffer(tuple(shape[:2]) + (3,), np.float32)
+        self.out = None
+        # Mesh uploaded for views rendered on the server
+        self.mesh = None
+        # Modification time of the texture file the session started from, None without one
+        self.source_mtime = None
+
+    @classmethod
+    def load(cls, out_txt_path, size=768, session_id=None):
+        source_mtime = file_mtime(out_txt_path)
+        if source_mtime is None:
+            return cls(out_txt_path, (size, size), session_id)
+        # PIL decodes the whole file once, it is the only full copy in memory besides the session buffers.
+        # Bands are cropped from it and converted to RGB one at a time.
+        with Image.open(out_txt_path) as img:
+            session = cls(out_txt_path, (img.height, img.width), session_id)
+            for rows in session.bands():
+                band = img.crop((0, rows.start, img.width, rows.stop)).convert("RGB")
+                session.set_texture(rows, np.asarray(band))
+        session.source_mtime = source_mtime
+        return session
+
+    @property
+    def memmapped(self):
+        return isinstance(self.weight, np.memmap)
+
+    def buffer(self, shape, dtype):
+        if shape[0] * shape[1] <= self.memmap_texels:
+            return np.zeros(shape, dtype=dtype)
+        fd, path = tempfile.mkstemp(prefix=F"sdtg4b_{self.id}_", suffix=".bin", dir=self.storage_dir)
+        os.close(fd)
+        self.files.append(path)
+        # A new file reads as zeros without being written
+        return np.memmap(path, dtype=dtype, mode="w+", shape=shape)
+
+    def bands(self, shape=None):
+        height, width = (shape or self.weight.shape)[:2]
+        band_rows = max(BAND_TEXELS // width, 1)
+        for start in range(0, height, band_rows):
+            yield slice(start, min(start + band_rows, height))
+
+    def set_texture(self, rows, texture):
+        _, has_color = _empty_texels(texture)
+        self.weight[rows] = has_color * np.float32(self.prior_weight)
+        self.color[rows] = texture[..., :3].astype(np.float32) * self.weight[rows][..., np.newaxis]
+
+    def add_view(self, img_arr, uv_img_arr, alpha_arr, depth_arr, depth_based_mixing):
+        index = build_view_index(self.weight.shape, uv_img_arr, alpha_arr, depth_arr)
+        self.add_samples(img_arr, index, depth_based_mixing)
+
+    def add_samples(self, img_arr, index, depth_based_mixing):
+        targets = np.asarray(index["texel"])
+        colors = sample_colors(img_arr, index)
+        with self.lock:
+            weight_flat = self.weight.reshape(-1)
+            color_flat = self.color.reshape(-1, 3)
+            if depth_based_mixing:
+                weights = np.maximum(1 - index["depth"].astype(np.float64), self.min_sample_weight)
+            else:
+                # Without mixing, only texels that no previous view has covered are filled
+                free = weight_flat[targets] == 0
+                targets = targets[free]
+                colors = colors[free]
+                weights = np.ones(len(targets))
+
+            texels, inverse = np.unique(targets, return_inverse=True)
+            sample_weight = np.bincount(inverse, weights)
+            sample_color = [np.bincount(inverse, weights * colors[:, channel]) for channel in range(3)]
+            # Texels are sorted, the update goes through the texture band by band
+            width = self.weight.shape[1]
+            bounds = np.searchsorted(texels, [rows.start * width for rows in self.bands()] + [weight_flat.size])
+            for start, stop in zip(bounds[:-1], bounds[1:]):
+                if start == stop:
                     continue
-                out_color = out_color / float(number_of_colors)
-                out_img_arr[x, y] = out_color
-
-    for x in range(out_img_arr.shape[0]):
-        for y in range(out_img_arr.shape[1]):
-            color = out_img_arr[x][y]
-            if sum(color) < 0.00001:
-                number_of_colors = 0
-                out_color = np.array([0, 0, 0])
-                for x1, y1 in [[x - 1, y], [x + 1, y]]:
-                    if x1 >= out_img_arr.shape[0] or y1 >= out_img_arr.shape[1]:
-                        continue
-                    c = out_img_arr[x1][y1]
-                    if sum(c) > 0.00001:
-                        out_color += c
-                        number_of_colors += 1
-                if number_of_colors == 0 or (partial and number_of_colors < 2):
+                tile = texels[start:stop]
+                weight_flat[tile] += sample_weight[start:stop]
+                for channel in range(3):
+                    color_flat[tile, channel] += sample_color[channel][start:stop]
+
+    def sample(self, uv):
+        # Current colors of the texels at UV coordinates, the diffuse pass of views rendered on the server
+        tex_h, tex_w = self.weight.shape
+        rows, cols = uv_texels(self.weight.shape, uv[:, 0], uv[:, 1])
+        rows, cols = rows % tex_h, cols % tex_w
+        with self.lock:
+            weight = np.maximum(self.weight[rows, cols], 0.000001)[:, np.newaxis]
+            return np.clip(np.rint(self.color[rows, cols] / weight), 0, 255).astype(np.uint8)
+
+    def resolve(self, partial, max_size=None):
+        height, width = self.weight.shape
+        with self.lock:
+            if max_size and max(height, width) > max_size:
+                # Preview of a large texture, every step-th texel is enough for the viewport
+                step = -(-max(height, width) // max_size)
+                weight = np.maximum(self.weight[::step, ::step], 0.000001)[..., np.newaxis]
+                out_img_arr = np.clip(np.rint(self.color[::step, ::step] / weight), 0, 255).astype(np.uint8)
+                return finish_texture(out_img_arr, partial=partial)
+
+            if not self.memmapped:
+                out_img_arr = np.empty((height, width, 3), dtype=np.uint8)
+            else:
+                if self.out is None:
+                    self.out = self.buffer((height, width, 3), np.uint8)
+                out_img_arr = self.out
+            for rows in self.bands():
+                weight = np.maximum(self.weight[rows], 0.000001)[..., np.newaxis]
+                out_img_arr[rows] = np.clip(np.rint(self.color[rows] / weight), 0, 255)
+        return finish_texture(out_img_arr, partial=partial)
+
+    def save(self, timer):
+        with timer.stage("finish"):
+            out_img_arr = self.resolve(partial=False)
+        with timer.stage("encode"):
+            if not self.memmapped:
+                Image.fromarray(out_img_arr, 'RGB').save(self.out_txt_path)
+                return out_img_arr
+            # OpenCV encodes the memory-mapped buffer in place, PIL would copy the whole texture first
+            for rows in self.bands():
+                out_img_arr[rows] = out_img_arr[rows, :, ::-1].copy()
+            cv2.imwrite(str(self.out_txt_path), out_img_arr)
+        return None
+
+    def close(self):
+        with self.lock:
+            self.weight = self.color = self.out = self.mesh = None
+            for path in self.files:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            self.files = []
+
+
+def load_passes(view, with_uv=True):
+    if "passes" in view:
+        return view["passes"]
+
+    passes = {
+        "depth": np.array(Image.open(view.get("depth")).convert("L")),
+        "alpha": np.array(Image.open(view.get("alpha")).convert("L")),
+        "diffuse": np.array(Image.open(view.get("diffuse")).convert("RGB")),
+    }
+    if with_uv:
+        os.environ["OPENCV_IO_ENABLE_OPENEXR"] = "1"
+        passes["uv"] = cv2.cvtColor(cv2.imread(view.get("uv"), cv2.IMREAD_UNCHANGED), cv2.COLOR_BGR2RGB)
+    return passes
+
+
+def prepare_view(view, passes):
+    strength = float(view.get("strength", 0.8))
+    original_alpha_img = Image.fromarray(passes["alpha"]).convert("RGB")
+    diffuse_img = Image.fromarray(passes["diffuse"])
+    gray = Image.new('RGB', diffuse_img.size, (128, 128, 128))
+    diffuse_img = ImageChops.blend(diffuse_img, gray, 0.5 * strength)
+    diffuse_img = ImageChops.multiply(diffuse_img, original_alpha_img)
+    # diffuse_img.save(r"C:\git\NeuralNetworksSketchbook\sd_texturing\tmp\test.png")
+    # Computed in floats, in place uint8 arithmetic wrapped around and fails with the current numpy
+    depth_arr = passes["depth"].astype(np.float32) * 1000 + 1000
+    return {"image": diffuse_img, "depth_map": depth_arr}
+
+
+def upscaled_size(passes):
+    height, width = passes["depth"].shape[:2]
+    return [width * 2, height * 2]
+
+
+def upscale_view(passes, img):
+    scaled_img_size = upscaled_size(passes)
+
+    # Scale for UV interpolation
+    img = np.array(img.resize(scaled_img_size, Image.Resampling.BICUBIC))
+    depth_arr = np.array(Image.fromarray(passes["depth"]).resize(scaled_img_size, Image.Resampling.BICUBIC))
+    uv_img = cv2.resize(passes["uv"], scaled_img_size, interpolation=cv2.INTER_CUBIC)
+    alpha_img = Image.fromarray(passes["alpha"]).resize(scaled_img_size, Image.Resampling.BICUBIC)
+
+    uv_img_arr = np.asarray(uv_img)
+    uv_img_arr = np.clip(uv_img_arr, 0, 1.0)
+    img_arr = np.asarray(img)
+    src_alpha_arr = np.array(alpha_img)
+    return img_arr, uv_img_arr, src_alpha_arr, depth_arr
+
+
+class ViewIndexStore:
+    # View indexes by the view_key sent by the add-on (a hash of the mesh, camera pose and render resolution)
+    # and the texture size. Recent ones stay in memory, with a directory they are also saved as .npy files
+    # and memory-mapped when loaded, so new prompts and seeds skip the UV pass and the index math.
+    # Indexes held in RAM are limited to memory_mb, memory-mapped ones only count towards max_entries.
+    # Saved indexes are trimmed to max_disk_mb by removing the least recently used files.
+    def __init__(self, directory=None, memory_mb=512, max_disk_mb=2048, max_entries=256):
+        self.directory = pathlib.Path(directory) if directory else None
+        self.memory = collections.OrderedDict()
+        self.memory_bytes = 0
+        self.max_memory_bytes = memory_mb * 2 ** 20
+        self.max_disk_bytes = max_disk_mb * 2 ** 20
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        if self.directory is not None:
+            self.directory.mkdir(parents=True, exist_ok=True)
+
+    def path(self, key):
+        return self.directory / F"{key}.npy"
+
+    def get(self, key):
+        if key in self.memory:
+            self.memory.move_to_end(key)
+            self.hits += 1
+            self.touch(key)
+            return self.memory[key]
+        if self.directory is not None and self.path(key).exists():
+            index = np.load(self.path(key), mmap_mode="r")
+            if index.dtype in (VIEW_INDEX_DTYPE, INVERSE_VIEW_INDEX_DTYPE):
+                self.hits += 1
+                self.touch(key)
+                self.remember(key, index)
+                return index
+        self.misses += 1
+        return None
+
+    def touch(self, key):
+        # The modification time of a saved index is its last use, trim removes the oldest ones first
+        if self.directory is None:
+            return
+        try:
+            os.utime(self.path(key))
+        except FileNotFoundError:
+            pass
+
+    @staticmethod
+    def resident_bytes(index):
+        # Pages of a memory-mapped index belong to the page cache, the system drops them under pressure
+        return 0 if isinstance(index, np.memmap) else index.nbytes
+
+    def remember(self, key, index):
+        if key in self.memory:
+            self.memory_bytes -= self.resident_bytes(self.memory.pop(key))
+        if self.resident_bytes(index) > self.max_memory_bytes:
+            return
+        self.memory[key] = index
+        self.memory_bytes += self.resident_bytes(index)
+        while self.memory_bytes > self.max_memory_bytes or len(self.memory) > self.max_entries:
+            _, old_index = self.memory.popitem(last=False)
+            self.memory_bytes -= self.resident_bytes(old_index)
+
+    def put(self, key, index):
+        if self.directory is None:
+            self.remember(key, index)
+            return
+        # Saved under a temporary name first, other workers never map a partial file
+        tmp_path = self.directory / F"{key}.{uuid.uuid4().hex}.tmp.npy"
+        np.save(tmp_path, index)
+        os.replace(tmp_path, self.path(key))
+        # The saved copy is kept instead of the built one, it does not hold on to RAM
+        self.remember(key, np.load(self.path(key), mmap_mode="r"))
+        self.trim()
+
+    def trim(self):
+        files = []
+        for path in self.directory.glob("*.npy"):
+            if path.name.endswith(".tmp.npy"):
+                continue
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= self.max_disk_bytes:
+                break
+            try:
+                # Mapped copies in this or other workers stay readable until they are dropped
+                path.unlink()
+            except FileNotFoundError:
+                pass
+            except OSError:
+                # Windows does not remove a file another worker has mapped, it is removed by a later trim
+                continue
+            total -= size
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "memory_size": len(self.memory),
+                "memory_mb": self.memory_bytes / 2 ** 20}
+
+
+VIEW_INDEXES = ViewIndexStore()
+
+
+def view_index_key(view, tex_shape, projection):
+    if not view.get("view_key"):
+        return None
+    return F"{view['view_key']}_{tex_shape[1]}x{tex_shape[0]}_{projection}"
+
+
+def project_generated_view(session, passes, img, key, index, projection, depth_based_mixing, timer):
+    if projection == "inverse":
+        native_size = (passes["depth"].shape[1], passes["depth"].shape[0])
+        with timer.stage("resize"):
+            if img.size != native_size:
+                img = img.resize(native_size, Image.Resampling.BICUBIC)
+            img_arr = np.asarray(img)
+        if index is None:
+            with timer.stage("index"):
+                index = build_inverse_view_index(session.weight.shape, np.clip(passes["uv"], 0, 1.0),
+                                                 passes["alpha"], passes["depth"])
+                if key is not None:
+                    VIEW_INDEXES.put(key, index)
+    elif index is not None:
+        with timer.stage("upscale"):
+            img_arr = np.asarray(img.resize(upscaled_size(passes), Image.Resampling.BICUBIC))
+    else:
+        with timer.stage("upscale"):
+            img_arr, uv_img_arr, alpha_arr, depth_arr = upscale_view(passes, img)
+        with timer.stage("index"):
+            index = build_view_index(session.weight.shape, uv_img_arr, alpha_arr, depth_arr)
+            if key is not None:
+                VIEW_INDEXES.put(key, index)
+    with timer.stage("project"):
+        session.add_samples(img_arr, index, depth_based_mixing)
+
+
+# Texture sessions keep the accumulated texture in memory between steps, it is only written to disk when
+# the session is finished. Requests without a session id use a session named after their out_txt file.
+SESSIONS = dict()
+SESSIONS_LOCK = threading.Lock()
+
+
+def create_session(data):
+    session = TextureSession.load(data.get("out_txt"), int(data.get("texture_size", 768)))
+    with SESSIONS_LOCK:
+        SESSIONS[session.id] = session
+    return session
+
+
+def get_session(data, create=True):
+    # Requests without a session_id use an implicit session of their out_txt path, created by the first job.
+    # It is read again when the file changed since, like the original server that read it on every step.
+    session_id = data.get("session_id")
+    with SESSIONS_LOCK:
+        if session_id is not None:
+            return SESSIONS[session_id]
+        out_txt_path = data.get("out_txt")
+        session = SESSIONS.get(out_txt_path)
+        if session is None and not create:
+            raise KeyError(F"Unknown session {out_txt_path}")
+        if session is None or session.source_mtime != file_mtime(out_txt_path):
+            if session is not None:
+                session.close()
+            session = TextureSession.load(out_txt_path, int(data.get("texture_size", 768)), session_id=out_txt_path)
+            SESSIONS[out_txt_path] = session
+        return session
+
+
+def discard_session(session):
+    with SESSIONS_LOCK:
+        SESSIONS.pop(session.id, None)
+    session.close()
+
+
+def discard_implicit_session(data):
+    # A failed or cancelled job leaves its implicit session partly accumulated, the next job starts from the file
+    if data.get("session_id") is not None:
+        return
+    with SESSIONS_LOCK:
+        session = SESSIONS.pop(data.get("out_txt"), None)
+    if session is not None:
+        session.close()
+
+
+def depth2img_views(backend, data, views, timer, cancelled, progress=None):
+    depth_based_mixing = int(data.get("depth_based_mixing", False))
+    projection = data.get("projection", "forward")
+    session = get_session(data)
+
+    keys = [view_index_key(view, session.weight.shape, projection) for view in views]
+    indexes = [VIEW_INDEXES.get(key) if key is not None else None for key in keys]
+    with timer.stage("decode"):
+        # With a stored index, the UV pass of the view is not needed anymore
+        passes = [load_passes(view, with_uv=index is None) for view, index in zip(views, indexes)]
+    with timer.stage("prepare"):
+        inputs = [prepare_view(view, view_passes) for view, view_passes in zip(views, passes)]
+    with timer.stage("diffusion"):
+        images = backend.generate(data, inputs, int(data.get("max_batch_size", 1)), cancelled, progress)
+    if cancelled.is_set():
+        raise JobCancelled()
+    if views[-1].get("render"):
+        with timer.stage("encode"):
+            images[-1].save(pathlib.Path(views[-1].get("render")).parent / "prev.png")
+
+    for view_passes, img, key, index in zip(passes, images, keys, indexes):
+        project_generated_view(session, view_passes, img, key, index, projection, depth_based_mixing, timer)
+
+
+def depth2img_step(backend, data, timer, cancelled, progress=None):
+    depth2img_views(backend, data, [data], timer, cancelled, progress)
+
+
+def depth2img_batch(backend, data, timer, cancelled, progress=None):
+    views = [dict(data, **view) for view in data.get("views")]
+    depth2img_views(backend, data, views, timer, cancelled, progress)
+
+
+def depth2img_raw(backend, data, arrays, timer, cancelled, progress=None):
+    views = []
+    for num, view in enumerate(data.get("views")):
+        passes = {name: arrays[F"{num}/{name}"] for name in ("depth", "uv", "alpha", "diffuse")}
+        views.append(dict(data, passes=passes, **view))
+    depth2img_views(backend, data, views, timer, cancelled, progress)
+
+
+def render_session_view(session, camera):
+    if session.mesh is None:
+        raise RuntimeError("No mesh was uploaded to the session")
+    return render_mesh_passes(session.mesh, camera, session.sample)
+
+
+def depth2img_mesh(backend, data, timer, cancelled, progress=None):
+    # Views given by their cameras, the passes are rendered from the mesh of the session when the job starts,
+    # so the diffuse pass shows the texture with all previous jobs of the session projected
+    session = get_session(data)
+    views = []
+    with timer.stage("render"):
+        for view in data.get("views"):
+            view = dict(data, **view)
+            view["passes"] = render_session_view(session, view["camera"])
+            view.setdefault("view_key", camera_view_key(session.mesh, view["camera"]))
+            views.append(view)
+    depth2img_views(backend, data, views, timer, cancelled, progress)
+
+
+def finish_texture_step(data, timer):
+    session = get_session(data)
+    texture = session.save(timer)
+    discard_session(session)
+    # The texture goes back with the job when the client can take it, larger ones are only in the written file
+    if texture is not None and max(texture.shape[:2]) <= (data.get("return_texture_size") or 0):
+        return {"texture": texture}
+    return None
+
+
+class StageTimer:
+    def __init__(self):
+        self.stages = dict()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        started_at = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[name] = self.stages.get(name, 0.0) + time.perf_counter() - started_at
+
+
+class Job:
+    def __init__(self, kind, data, timer=None):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.data = data
+        self.timer = timer or StageTimer()
+        self.worker = None
+        # Position of the job in the tasks queue of its worker
+        self.sequence = None
+        self.gpu_peak_mb = None
+        self.state = "queued"
+        self.error = None
+        self.queued_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        # Denoising progress and the latest preview image reported by the worker, version counts the updates
+        self.progress = None
+        self.preview = None
+        self.version = 0
+        # Arrays returned by the job, fetched once from /jobs/<id>/result
+        self.result = None
+
+    @property
+    def finished(self):
+        return self.state in ("done", "error", "cancelled")
+
+    def to_dict(self):
+        now = time.time()
+        return {
+            "job_id": self.id,
+            "kind": self.kind,
+            "state": self.state,
+            "error": self.error,
+            "worker": self.worker,
+            "queued_at": self.queued_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "wait_time": (self.started_at or now) - self.queued_at,
+            "run_time": (self.finished_at or now) - self.started_at if self.started_at else 0.0,
+            "stages": dict(self.timer.stages),
+            "gpu_peak_mb": self.gpu_peak_mb,
+            "progress": self.progress,
+            "result": sorted(self.result) if self.result is not None else None,
+        }
+
+
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started_at = time.time()
+        self.kinds = dict()
+        self.gpu_peak_mb = None
+
+    def record(self, job):
+        with self.lock:
+            entry = self.kinds.setdefault(job.kind, {"done": 0, "error": 0, "cancelled": 0, "wait_time": 0.0,
+                                                      "run_time": 0.0, "max_run_time": 0.0, "stages": dict()})
+            run_time = job.finished_at - job.started_at
+            entry[job.state] += 1
+            entry["wait_time"] += job.started_at - job.queued_at
+            entry["run_time"] += run_time
+            entry["max_run_time"] = max(entry["max_run_time"], run_time)
+            for name, stage_time in job.timer.stages.items():
+                stage = entry["stages"].setdefault(name, {"total": 0.0, "max": 0.0})
+                stage["total"] += stage_time
+                stage["max"] = max(stage["max"], stage_time)
+            if job.gpu_peak_mb is not None:
+                self.gpu_peak_mb = max(self.gpu_peak_mb or 0.0, job.gpu_peak_mb)
+
+    def to_dict(self):
+        with JOBS_LOCK:
+            states = [job.state for job in JOBS.values()]
+        with self.lock:
+            kinds = copy.deepcopy(self.kinds)
+        return {
+            "uptime": time.time() - self.started_at,
+            "queue_depth": states.count("queued"),
+            "running": states.count("running"),
+            "jobs": kinds,
+            "gpu_peak_mb": self.gpu_peak_mb,
+            "gpu_memory": {worker.id: worker.memory for worker in WORKERS if worker.memory is not None},
+            "backend": {worker.id: worker.stats for worker in WORKERS},
+        }
+
+
+# ------------------------------------------------------------------------
+#    Worker processes
+# ------------------------------------------------------------------------
+
+FINISH_PATHS = ("/finish_texture", "/session/finish")
+
+
+class WorkerProcess:
+    # Runs in a child process with its own backend and the texture sessions assigned to it. Jobs come in
+    # order from the tasks queue, session requests and cancellation from the control queue, so they are
+    # answered while a job is running. Progress goes back to the server process through the events queue.
+    def __init__(self, worker_id, tasks, control, events):
+        self.id = worker_id
+        self.tasks = tasks
+        self.control = control
+        self.events = events
+        self.backend = None
+        self.lock = threading.Lock()
+        self.job_id = None
+        self.cancelled = threading.Event()
+        # Jobs cancelled while still in the tasks queue, dropped when they are taken from it. Jobs are numbered
+        # in the order the server queues them, the ones up to `dequeued` have been taken already.
+        self.cancelled_jobs = set()
+        self.dequeued = 0
+
+    def run(self, backend_name, backend_options, cache_options, storage_options):
+        global VIEW_INDEXES
+        VIEW_INDEXES = ViewIndexStore(storage_options["index_dir"], storage_options["index_memory_mb"],
+                                      storage_options["index_disk_mb"])
+        TextureSession.storage_dir = storage_options["session_dir"]
+        threading.Thread(target=self.control_loop, daemon=True).start()
+        threading.Thread(target=self.exit_with_server, daemon=True).start()
+        backend = create_backend(backend_name, **backend_options)
+        started_at = time.time()
+        try:
+            backend.load()
+            self.backend = backend
+            if cache_options is not None:
+                self.backend = CachedBackend(backend, ResultCache(**cache_options))
+            print(F"Worker {self.id}: backend {backend.name} ready in {time.time() - started_at:.1f}s")
+            self.events.put(("state", self.id, "ready", None, backend.to_dict()))
+        except Exception as e:
+            traceback.print_exc()
+            self.events.put(("state", self.id, "error", F"{type(e).__name__}: {e}", backend.to_dict()))
+
+        while True:
+            job_id, kind, data, arrays = self.tasks.get()
+            with self.lock:
+                self.dequeued += 1
+                if job_id in self.cancelled_jobs:
+                    self.cancelled_jobs.discard(job_id)
+                    self.events.put(("finished", job_id, "cancelled", None, {}, None, {}, None))
                     continue
-                out_color = out_color / float(number_of_colors)
-                out_img_arr[x, y] = out_color
-    return out_img_arr
+                self.job_id = job_id
+                self.cancelled = threading.Event()
+            self.events.put(("started", job_id, time.time()))
+            self.run_job(job_id, kind, data, arrays)
+            with self.lock:
+                self.job_id = None
+
+    def progress_callback(self, job_id):
+        sent_at = 0.0
+
+        def progress(step, steps, fraction, preview=None):
+            nonlocal sent_at
+            # Steps of fast backends are reported at most every PROGRESS_INTERVAL, previews always
+            if preview is None and step != steps and time.time() - sent_at < PROGRESS_INTERVAL:
+                return
+            sent_at = time.time()
+            self.events.put(("progress", job_id, {"step": step, "steps": steps, "fraction": fraction}, preview))
+        return progress
+
+    def run_job(self, job_id, kind, data, arrays):
+        timer = StageTimer()
+        memory = None
+        error = None
+        result = None
+        progress = self.progress_callback(job_id)
+        try:
+            if kind in FINISH_PATHS:
+                result = finish_texture_step(data, timer)
+            else:
+                if self.backend is None:
+                    raise RuntimeError("Model could not be loaded")
+                self.backend.reset_peak_memory()
+                if kind == "/depth2img_step":
+                    depth2img_step(self.backend, data, timer, self.cancelled, progress)
+                elif kind == "/depth2img_batch":
+                    depth2img_batch(self.backend, data, timer, self.cancelled, progress)
+                elif kind == "/depth2img_raw":
+                    depth2img_raw(self.backend, data, arrays, timer, self.cancelled, progress)
+                elif kind == "/depth2img_mesh":
+                    depth2img_mesh(self.backend, data, timer, self.cancelled, progress)
+                memory = self.backend.memory_stats()
+            state = "done"
+        except JobCancelled:
+            state = "cancelled"
+        except Exception as e:
+            traceback.print_exc()
+            error = F"{type(e).__name__}: {e}"
+            state = "error"
+        if state != "done":
+            discard_implicit_session(data)
+        if state == "cancelled" and self.backend is not None:
+            # Activations of the interrupted call are released with the exception, return them to the GPU pool
+            self.backend.free_memory()
+        stats = dict(self.backend.stats() if self.backend is not None else {}, view_index=VIEW_INDEXES.stats())
+        self.events.put(("finished", job_id, state, error, timer.stages, memory, stats, result))
+
+    @staticmethod
+    def exit_with_server():
+        # Daemon workers are only stopped when the server exits cleanly, not when it is killed
+        multiprocessing.parent_process().join()
+        os._exit(0)
+
+    def control_loop(self):
+        while True:
+            kind, request_id, data = self.control.get()
+            result = None
+            error = None
+            try:
+                if kind == "cancel":
+                    with self.lock:
+                        if self.job_id == data["job_id"]:
+                            self.cancelled.set()
+                        elif data["sequence"] > self.dequeued:
+                            self.cancelled_jobs.add(data["job_id"])
+                elif kind == "/session/create":
+                    result = create_session(data).id
+                elif kind == "/session/discard":
+                    with contextlib.suppress(KeyError):
+                        discard_session(get_session(data, create=False))
+                elif kind == "/texture":
+                    result = get_session(data, create=False).resolve(partial=True, max_size=data.get("max_size"))
+                elif kind == "/session/mesh":
+                    get_session(data).mesh = data["mesh"]
+                elif kind == "/session/render":
+                    result = render_session_view(get_session(data, create=False), data["camera"])
+            except Exception as e:
+                error = F"{type(e).__name__}: {e}"
+            if request_id is not None:
+                self.events.put(("reply", request_id, result, error))
+
+
+def worker_main(worker_id, backend_name, backend_options, cache_options, storage_options, tasks, control, events):
+    WorkerProcess(worker_id, tasks, control, events).run(backend_name, backend_options, cache_options,
+                                                         storage_options)
+
+
+class WorkerHandle:
+    # Server process side of a worker: its queues and the last state it reported
+    def __init__(self, context, worker_id, backend_name, backend_options, cache_options, storage_options, events):
+        self.id = worker_id
+        self.tasks = context.Queue()
+        self.control = context.Queue()
+        self.state = "loading"
+        self.error = None
+        self.backend = dict(backend_options, backend=backend_name)
+        self.memory = None
+        self.stats = dict()
+        # Number of jobs put in the tasks queue, the worker takes them in the same order
+        self.queued = 0
+        self.process = context.Process(target=worker_main, daemon=True,
+                                       args=(worker_id, backend_name, backend_options, cache_options, storage_options,
+                                             self.tasks, self.control, events))
+
+    def pending_jobs(self):
+        return sum(job.worker == self.id and job.state in ("queued", "running") for job in JOBS.values())
+
+    def to_dict(self):
+        with JOBS_LOCK:
+            pending = self.pending_jobs()
+        return dict(self.backend, worker=self.id, state=self.state, error=self.error, pending=pending,
+                    alive=self.process.is_alive(), exitcode=self.process.exitcode)
+
+
+class Reply:
+    def __init__(self, worker):
+        self.worker = worker
+        self.ready = threading.Event()
+        self.result = None
+        self.error = None
+
+
+DEPTH2IMG_PATHS = ("/depth2img_step", "/depth2img_batch", "/depth2img_raw", "/depth2img_mesh")
+JOB_PATHS = DEPTH2IMG_PATHS + FINISH_PATHS
+SESSION_PATHS = ("/session/create", "/session/discard", "/texture", "/session/mesh", "/session/render")
+MAX_FINISHED_JOBS = 256
+JOBS = dict()
+JOBS_LOCK = threading.Lock()
+# Notified on every change of a job, streams of job events wait on it
+JOB_UPDATES = threading.Condition(JOBS_LOCK)
+PROGRESS_INTERVAL = 0.2
+EVENTS_KEEPALIVE = 15
+WORKERS = []
+# Every texture session lives in one worker, all its steps go to that worker and run in order.
+# Keys are session ids, or out_txt paths for requests without a session. Guarded by JOBS_LOCK.
+SESSION_OWNERS = dict()
+REPLIES = dict()
+REPLIES_LOCK = threading.Lock()
+
+
+def session_key(data):
+    return data.get("session_id") or data.get("out_txt")
+
+
+def least_loaded_worker():
+    owned = [0] * len(WORKERS)
+    for worker in SESSION_OWNERS.values():
+        owned[worker.id] += 1
+    return min(WORKERS, key=lambda worker: (worker.state == "error", worker.pending_jobs(), owned[worker.id]))
+
+
+def session_owner(data):
+    # Has to be called with JOBS_LOCK held
+    key = session_key(data)
+    if key not in SESSION_OWNERS:
+        SESSION_OWNERS[key] = least_loaded_worker()
+    return SESSION_OWNERS[key]
+
+
+def call_worker(worker, kind, data, timeout=60):
+    if not worker.process.is_alive():
+        raise RuntimeError(worker.error or F"Worker {worker.id} is not running")
+    request_id = uuid.uuid4().hex
+    reply = Reply(worker)
+    with REPLIES_LOCK:
+        REPLIES[request_id] = reply
+    worker.control.put((kind, request_id, data))
+    if not reply.ready.wait(timeout):
+        with REPLIES_LOCK:
+            REPLIES.pop(request_id, None)
+        raise RuntimeError(F"Worker {worker.id} did not answer {kind} in {timeout}s")
+    if reply.error is not None:
+        raise RuntimeError(reply.error)
+    return reply.result
+
+
+def submit_job(kind, data, arrays=None, timer=None):
+    job = Job(kind, data, timer)
+    with JOBS_LOCK:
+        finished = [j for j in JOBS.values() if j.finished]
+        for old_job in finished[:max(len(finished) - MAX_FINISHED_JOBS, 0)]:
+            del JOBS[old_job.id]
+        worker = session_owner(data)
+        job.worker = worker.id
+        JOBS[job.id] = job
+        if not worker.process.is_alive():
+            # Nothing would take the job from the queue of a worker that has exited
+            job.state = "error"
+            job.error = worker.error or F"Worker {worker.id} is not running"
+            job.started_at = job.finished_at = time.time()
+            SESSION_OWNERS.pop(session_key(data), None)
+            return job
+        worker.queued += 1
+        job.sequence = worker.queued
+        worker.tasks.put((job.id, kind, data, arrays))
+    return job
+
+
+def cancel_job(job):
+    # A queued job is dropped right away, a running one stops after the current denoising step
+    with JOBS_LOCK:
+        queued = job.state == "queued"
+        if queued:
+            job.state = "cancelled"
+            job.started_at = job.finished_at = time.time()
+            job.version += 1
+            JOB_UPDATES.notify_all()
+        elif job.state != "running":
+            return
+        worker = WORKERS[job.worker]
+    worker.control.put(("cancel", None, {"job_id": job.id, "sequence": job.sequence}))
+    if queued:
+        METRICS.record(job)
+
+
+def worker_exited(worker):
+    # The jobs, sessions and pending replies of a worker are lost with its process
+    worker.state = "error"
+    worker.error = F"Worker {worker.id} exited with code {worker.process.exitcode}"
+    now = time.time()
+    with JOBS_LOCK:
+        lost = [job for job in JOBS.values() if job.worker == worker.id and not job.finished]
+        for job in lost:
+            job.state = "error"
+            job.error = worker.error
+            job.started_at = job.started_at or now
+            job.finished_at = now
+            job.version += 1
+        for key in [key for key, owner in SESSION_OWNERS.items() if owner is worker]:
+            del SESSION_OWNERS[key]
+        JOB_UPDATES.notify_all()
+    with REPLIES_LOCK:
+        replies = [request_id for request_id, reply in REPLIES.items() if reply.worker is worker]
+        replies = [REPLIES.pop(request_id) for request_id in replies]
+    for reply in replies:
+        reply.error = worker.error
+        reply.ready.set()
+    for job in lost:
+        METRICS.record(job)
+    print(F"{worker.error}, {len(lost)} jobs failed")
+
+
+def watch_workers():
+    # Workers only exit on their own when they crash, e.g. killed for running out of memory
+    running = list(WORKERS)
+    while running:
+        exited = multiprocessing.connection.wait([worker.process.sentinel for worker in running])
+        for worker in [worker for worker in running if worker.process.sentinel in exited]:
+            worker.process.join()
+            running.remove(worker)
+            worker_exited(worker)
+
+
+def event_loop(events):
+    while True:
+        event = events.get()
+        if event[0] == "state":
+            _, worker_id, state, error, backend_info = event
+            worker = WORKERS[worker_id]
+            if not worker.process.is_alive():
+                # Sent before the worker exited, its error state stays
+                continue
+            worker.backend = backend_info
+            worker.error = error
+            worker.state = state
+        elif event[0] == "started":
+            _, job_id, started_at = event
+            with JOBS_LOCK:
+                job = JOBS.get(job_id)
+                if job is not None and job.state == "queued":
+                    job.state = "running"
+                    job.started_at = started_at
+                    job.version += 1
+                    JOB_UPDATES.notify_all()
+        elif event[0] == "progress":
+            _, job_id, progress, preview = event
+            with JOBS_LOCK:
+                job = JOBS.get(job_id)
+                if job is not None and job.state == "running":
+                    job.progress = progress
+                    if preview is not None:
+                        job.preview = preview
+                    job.version += 1
+                    JOB_UPDATES.notify_all()
+        elif event[0] == "finished":
+            _, job_id, state, error, stages, memory, stats, result = event
+            with JOBS_LOCK:
+                job = JOBS.get(job_id)
+                if job is None or job.state != "running":
+                    continue
+                job.state = state
+                job.error = error
+                job.result = result
+                job.timer.stages.update(stages)
+                job.finished_at = time.time()
+                if stats:
+                    WORKERS[job.worker].stats = stats
+                if memory is not None:
+                    job.gpu_peak_mb = memory["peak_mb"]
+                    WORKERS[job.worker].memory = memory
+                key = session_key(job.data)
+                if job.kind in FINISH_PATHS and state == "done":
+                    SESSION_OWNERS.pop(key, None)
+                elif state != "done" and job.data.get("session_id") is None and \
+                        not any(session_key(other.data) == key and not other.finished for other in JOBS.values()):
+                    # The worker dropped the implicit session of the failed job and no other job needs it
+                    SESSION_OWNERS.pop(key, None)
+                job.version += 1
+                JOB_UPDATES.notify_all()
+            METRICS.record(job)
+            stages = ", ".join(F"{name} {stage_time:.2f}s" for name, stage_time in job.timer.stages.items())
+            print(F"Request {job.kind} processed by worker {job.worker}: {job.state} in "
+                  F"{job.finished_at - job.started_at:.2f}s ({stages})")
+        elif event[0] == "reply":
+            _, request_id, result, error = event
+            with REPLIES_LOCK:
+                reply = REPLIES.pop(request_id, None)
+            if reply is not None:
+                reply.result = result
+                reply.error = error
+                reply.ready.set()
+
+
+def server_status():
+    workers = [worker.to_dict() for worker in WORKERS]
+    states = [worker["state"] for worker in workers]
+    if "ready" in states:
+        state = "ready"
+    elif "loading" in states:
+        state = "loading"
+    else:
+        state = "error"
+    errors = [worker["error"] for worker in workers if worker["error"]]
+    with JOBS_LOCK:
+        queued = sum(job.state == "queued" for job in JOBS.values())
+    return dict(workers[0], state=state, error=errors[0] if errors else None, queued=queued, workers=workers)
+
+
+METRICS = Metrics()
 
 
 class Handler(BaseHTTPRequestHandler):
-    depth2img_pipe = StableDiffusionDepth2ImgPipeline.from_pretrained(
-        "stabilityai/stable-diffusion-2-depth",
-        torch_dtype=torch.float16,
-    ).to("cuda")
+    # Keep-alive connections, the add-on sends all its requests over a few pooled ones
+    protocol_version = "HTTP/1.1"
+
+    def send_json(self, code, payload):
+        body = bytes(json.dumps(payload), "utf8")
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_arrays(self, code, params, arrays):
+        body = pack_arrays(params, arrays)
+        self.send_response(code)
+        self.send_header('Content-Type', TRANSPORT_CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_event(self, event, payload):
+        self.wfile.write(bytes(F"event: {event}\ndata: {json.dumps(payload)}\n\n", "utf8"))
+        self.wfile.flush()
+
+    def send_job_events(self, job):
+        # Server-sent events: "job" with the state and progress of the job on every change, "preview" with every
+        # new preview image as base64 encoded RGB bytes, top row first. The stream ends with the "job" event
+        # of the finished job.
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        # The stream has no length, it ends by closing the connection
+        self.send_header('Connection', 'close')
+        self.close_connection = True
+        self.end_headers()
+        version = -1
+        preview = None
+        try:
+            while True:
+                with JOB_UPDATES:
+                    if not JOB_UPDATES.wait_for(lambda: job.version != version, timeout=EVENTS_KEEPALIVE):
+                        # Comment line, it only checks that the client is still connected
+                        self.wfile.write(b": keepalive\n\n")
+                        self.wfile.flush()
+                        continue
+                    version = job.version
+                    finished = job.finished
+                    payload = job.to_dict()
+                    new_preview = job.preview if job.preview is not preview else None
+                    preview = job.preview
+                if new_preview is not None:
+                    self.send_event("preview", {"job_id": job.id, "progress": payload["progress"],
+                                                "shape": list(new_preview.shape),
+                                                "data": str(base64.b64encode(new_preview.tobytes()), "ascii")})
+                self.send_event("job", payload)
+                if finished:
+                    return
+        except (BrokenPipeError, ConnectionResetError):
+            pass
 
     # noinspection PyPep8Naming
     def do_GET(self):
+        try:
+            self.handle_get()
+        except (ValueError, KeyError, TypeError) as e:
+            # Malformed payload, e.g. bad JSON, a bad array header or fields of the wrong type
+            self.send_json(400, {"error": F"Incorrect payload: {type(e).__name__}: {e}"})
+        except RuntimeError as e:
+            # Session requests answered by a worker, e.g. an unknown implicit session or a worker timeout
+            self.send_json(500, {"error": str(e)})
+
+    def handle_get(self):
+        timer = StageTimer()
+        with timer.stage("receive"):
+            # Read for every request, even when it is not used, so the next request on the connection starts clean
+            length = self.headers.get('content-length', "0")
+            if not length.isdigit():
+                # The body cannot be skipped, send_error closes the connection
+                self.send_error(400, "Incorrect Content-Length")
+                return
+            length = int(length)
+            field_data = self.rfile.read(length)
+
         if self.path == "/status":
-            self.send_response(200)
-            self.send_header('python 3 ', 'text/html')
-            self.end_headers()
+            self.send_json(200, server_status())
             return
 
-        length = int(self.headers.get('content-length'))
-        field_data = self.rfile.read(length)
-        data = json.loads(str(field_data, "UTF-8"))
+        if self.path == "/metrics":
+            self.send_json(200, METRICS.to_dict())
+            return
 
-        prompt = data.get("prompt")
-        n_prompt = data.get("n_prompt", "")
+        if self.path.startswith("/jobs/"):
+            job_id, _, action = self.path[len("/jobs/"):].partition("/")
+            with JOBS_LOCK:
+                job = JOBS.get(job_id)
+            if job is None or action not in ("", "cancel", "events", "result"):
+                self.send_json(404, {"error": "Unknown job"})
+                return
+            if action == "events":
+                self.send_job_events(job)
+                return
+            if action == "result":
+                # Sent once, the arrays are not kept with the finished jobs
+                with JOBS_LOCK:
+                    result, job.result = job.result, None
+                if result is None:
+                    self.send_json(404, {"error": "The job has no result"})
+                    return
+                self.send_arrays(200, {}, result)
+                return
+            if action == "cancel":
+                cancel_job(job)
+            self.send_json(200, job.to_dict())
+            return
 
-        num_inference_steps = data.get("steps")
-        depth_path = data.get("depth")
-        src_path = data.get("render")
-        uv_path = data.get("uv")
-        alpha_path = data.get("alpha")
-        out_txt_path = data.get("out_txt")
-        diffuse_path = data.get("diffuse")
-        strength = float(data.get("strength", 0.8))
-        depth_based_mixing = int(data.get("depth_based_mixing", False))
+        if self.path not in JOB_PATHS + SESSION_PATHS:
+            self.send_json(404, {"error": F"Unknown path {self.path}"})
+            return
 
-        seed = data.get("seed", 1024)
-        generator = torch.Generator(device="cuda").manual_seed(seed)
+        with timer.stage("receive"):
+            arrays = None
+            if self.headers.get('content-type') == TRANSPORT_CONTENT_TYPE:
+                data, arrays = unpack_arrays(field_data)
+            else:
+                data = json.loads(str(field_data, "UTF-8"))
+            if not isinstance(data, dict):
+                raise TypeError(F"expected a JSON object, got {type(data).__name__}")
 
-        if prompt is None or out_txt_path is None:
-            self.send_response(400)
-            self.send_header('Incorrect payload', 'text/html')
-            self.end_headers()
+        if self.path == "/session/create":
+            if data.get("out_txt") is None:
+                self.send_json(400, {"error": "Incorrect payload"})
+                return
+            with JOBS_LOCK:
+                worker = least_loaded_worker()
+            session_id = call_worker(worker, self.path, data)
+            with JOBS_LOCK:
+                SESSION_OWNERS[session_id] = worker
+            self.send_json(200, {"session_id": session_id})
             return
 
-        self.send_response(200)
-        self.send_header('python 3 ', 'text/html')
-        self.end_headers()
+        if data.get("session_id") is None and data.get("out_txt") is None:
+            self.send_json(400, {"error": "Incorrect payload"})
+            return
+        with JOBS_LOCK:
+            # Read-only requests never create an implicit session, it only exists after a job for its path
+            if (data.get("session_id") is not None or self.path in ("/texture", "/session/render")) and \
+                    session_key(data) not in SESSION_OWNERS:
+                self.send_json(404, {"error": "Unknown session"})
+                return
 
-        if self.path == "/depth2img_step":
-            init_img = Image.open(src_path)
-            original_alpha_img = Image.open(alpha_path).convert("RGB")
-            diffuse_img = Image.open(diffuse_path)
-            gray = Image.new('RGB', diffuse_img.size, (128, 128, 128))
-            diffuse_img = ImageChops.blend(diffuse_img, gray, 0.5 * strength)
-            diffuse_img = ImageChops.multiply(diffuse_img, original_alpha_img)
-            # diffuse_img.save(r"C:\git\NeuralNetworksSketchbook\sd_texturing\tmp\test.png")
-            depth_arr = np.array(Image.open(depth_path).convert("L"))
-            depth_arr *= 1000
-            depth_arr += 1000
-            depth_arr = np.expand_dims(depth_arr, axis=0)
-            depth_arr = torch.from_numpy(depth_arr)
-
-            img = self.depth2img_pipe(prompt=prompt, image=diffuse_img, depth_map=depth_arr, negative_prompt=n_prompt,
-                                      guidance_scale=9, strength=0.8, generator=generator,
-                                      num_inference_steps=num_inference_steps, num_images_per_prompt=1).images[0]
-            img.save(pathlib.Path(src_path).parent / "prev.png")
-
-            os.environ["OPENCV_IO_ENABLE_OPENEXR"] = "1"
-
-            scaled_img_size = [x * 2 for x in init_img.size]
-
-            # Scale for UV interpolation
-            img = np.array(img.resize(scaled_img_size, Image.Resampling.BICUBIC))
-            depth_arr = np.array(Image.open(depth_path).resize(scaled_img_size, Image.Resampling.BICUBIC))
-            uv_img = cv2.imread(uv_path, cv2.IMREAD_UNCHANGED)
-            uv_img = cv2.cvtColor(uv_img, cv2.COLOR_BGR2RGB)
-            uv_img = cv2.resize(uv_img, scaled_img_size, interpolation=cv2.INTER_CUBIC)
-            alpha_img = Image.open(alpha_path).resize(scaled_img_size, Image.Resampling.BICUBIC)
-
-            # diffuse_img = Image.open(diffuse_path)
-
-            uv_img_arr = np.asarray(uv_img)
-            uv_img_arr = np.clip(uv_img_arr, 0, 1.0)
-            img_arr = np.asarray(img)
+        if self.path == "/session/discard":
+            with JOBS_LOCK:
+                worker = SESSION_OWNERS.pop(session_key(data), None)
+            if worker is not None:
+                call_worker(worker, self.path, data)
+            self.send_json(200, {})
+            return
+
+        if self.path == "/texture":
+            with JOBS_LOCK:
+                worker = session_owner(data)
+            self.send_arrays(200, {}, {"texture": call_worker(worker, self.path, data)})
+            return
+
+        if self.path == "/session/mesh":
+            # Raw arrays (positions, triangles, uvs) or the path of an OBJ file readable by the server
+            try:
+                if arrays is not None:
+                    mesh = Mesh.from_arrays(arrays)
+                else:
+                    mesh = Mesh.load_obj(data["obj"])
+            except (KeyError, ValueError, IndexError, OSError) as e:
+                self.send_json(400, {"error": F"Incorrect mesh: {type(e).__name__}: {e}"})
+                return
+            with JOBS_LOCK:
+                worker = session_owner(data)
+            call_worker(worker, self.path, dict(data, mesh=mesh))
+            self.send_json(200, {"mesh_key": mesh.key, "vertices": len(mesh.positions),
+                                 "triangles": len(mesh.triangles)})
+            return
+
+        if self.path == "/session/render":
+            if not data.get("camera"):
+                self.send_json(400, {"error": "Incorrect payload"})
+                return
+            with JOBS_LOCK:
+                worker = session_owner(data)
+            self.send_arrays(200, {}, call_worker(worker, self.path, data))
+            return
+
+        if self.path in DEPTH2IMG_PATHS and data.get("prompt") is None or \
+                (self.path in ("/depth2img_batch", "/depth2img_raw", "/depth2img_mesh") and not data.get("views")) or \
+                not all(isinstance(view, dict) for view in data.get("views") or ()) or \
+                (self.path == "/depth2img_mesh" and not all(view.get("camera") for view in data.get("views"))) or \
+                data.get("projection", "forward") not in PROJECTIONS or \
+                (self.path == "/depth2img_raw" and (arrays is None or
+                                                    len(arrays) != 4 * len(data.get("views")))):
+            self.send_json(400, {"error": "Incorrect payload"})
+            return
+
+        job = submit_job(self.path, data, arrays, timer)
+        self.send_json(200, job.to_dict())
+
+
+def start_server(port, host='127.0.0.1', backend="diffusers", workers=None, devices=("auto",), cache_options=None,
+                 index_dir=None, index_memory_mb=512, index_disk_mb=2048, session_dir=None, **backend_options):
+    # CUDA cannot be used in forked processes, workers always start from a fresh interpreter
+    context = multiprocessing.get_context("spawn")
+    events = context.Queue()
+    for worker_id in range(workers or len(devices)):
+        options = dict(backend_options)
+        if backend == "diffusers":
+            options["device"] = devices[worker_id % len(devices)]
+        storage_options = {"index_dir": index_dir, "index_memory_mb": index_memory_mb, "index_disk_mb": index_disk_mb,
+                           "session_dir": session_dir}
+        WORKERS.append(WorkerHandle(context, worker_id, backend, options, cache_options, storage_options, events))
 
-            out_img = Image.open(out_txt_path)
-            out_img_arr = np.array(out_img)
-            wip_out_img_arr = out_img_arr.copy()
-            src_alpha_arr = np.array(alpha_img)
-
-            for x in range(uv_img_arr.shape[0]):
-                for y in range(uv_img_arr.shape[1]):
-                    u, v, w = uv_img_arr[x][y]
-                    a = src_alpha_arr[x][y]
-                    try:
-                        if a > 244 and sum([u, v, w]) > 0.00000001:
-                            u2 = int(out_img_arr.shape[1] - 1) - int(out_img_arr.shape[1] * v) - 1
-                            v2 = int(out_img_arr.shape[0] * u) - 1
-
-                            if depth_based_mixing and sum(out_img_arr[u2, v2]) > 0:
-                                depth = (np.clip(depth_arr[x][y][0] / 255, 0, 0.5) * 2) ** 2
-                                wip_out_img_arr[u2, v2] = img_arr[x][y] * (1 - depth) + out_img_arr[u2, v2] * depth
-                            else:
-                                wip_out_img_arr[u2, v2] = img_arr[x][y]
-                    except Exception as e:
-                        pass
-            for x in range(out_img_arr.shape[0]):
-                for y in range(out_img_arr.shape[1]):
-                    if depth_based_mixing:
-                        out_img_arr[x, y] = wip_out_img_arr[x][y]
-                    elif sum(out_img_arr[x, y]) == 0:
-                        out_img_arr[x, y] = wip_out_img_arr[x][y]
-
-            out_img_arr = finish_texture(out_img_arr, partial=True)
-            out = Image.fromarray(out_img_arr.astype('uint8'), 'RGB')
-            out.save(out_txt_path)
-
-        if self.path == "/finish_texture":
-            out_img = Image.open(out_txt_path)
-            out_img_arr = np.array(out_img)
-            out_img_arr = finish_texture(out_img_arr)
-            out = Image.fromarray(out_img_arr.astype('uint8'), 'RGB')
-            out.save(out_txt_path)
-
-        message = F"Request {self.path} processed"
-        print(message)
-        self.wfile.write(bytes(message, "utf8"))
-
-
-def start_server(port):
-    with HTTPServer(('127.0.0.1', port), Handler) as server:
+    # Requests are handled on their own threads, so /status, /jobs and cancellation answer during inference
+    with ThreadingHTTPServer((host, port), Handler) as server:
+        # The socket is open before the models are loaded, /status reports the loading state meanwhile
+        for worker in WORKERS:
+            worker.process.start()
+        threading.Thread(target=event_loop, args=(events,), daemon=True).start()
+        threading.Thread(target=watch_workers, daemon=True).start()
+        print(F"Serving on {host}:{port} with {len(WORKERS)} {backend} workers")
         server.serve_forever()
 
 
 if __name__ == "__main__":
-    start_server(5000)
+    parser = argparse.ArgumentParser(description="Stable Diffusion server for the SDTG4B Blender add-on")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--backend", default="diffusers", choices=tuple(BACKENDS),
+                        help="stub generates deterministic images on the CPU, for load tests without a GPU")
+    parser.add_argument("--stub-step-time", type=float, default=0.0,
+                        help="Seconds the stub backend spends on every inference step")
+    parser.add_argument("--port", type=int, default=5000)
+    parser.add_argument("--model", default="stabilityai/stable-diffusion-2-depth",
+                        help="Hugging Face model id of the depth2img pipeline")
+    parser.add_argument("--dtype", default="auto", choices=("auto", "float16", "bfloat16", "float32"),
+                        help="auto uses float16 on GPUs and float32 on the CPU")
+    parser.add_argument("--device", default="auto",
+                        help="Torch device, e.g. cuda, cuda:1 or cpu. auto falls back to the CPU without CUDA. "
+                             "A comma separated list, e.g. cuda:0,cuda:1, is shared between the workers")
+    parser.add_argument("--workers", type=int,
+                        help="Number of worker processes, each with its own pipeline. One per device by default")
+    parser.add_argument("--prompt-cache-size", type=int, default=32,
+                        help="Number of encoded prompts kept by every worker, 0 disables the cache")
+    parser.add_argument("--result-cache-size", type=int, default=64,
+                        help="Number of generated views kept in memory by every worker, so identical views "
+                             "are not generated again")
+    parser.add_argument("--result-cache-dir",
+                        help="Directory where generated views are also cached, shared by the workers and kept "
+                             "between server runs")
+    parser.add_argument("--result-cache-disk-mb", type=int, default=2048)
+    parser.add_argument("--index-dir",
+                        help="Directory where the UV to texel index of every camera view is saved, so next "
+                             "generations of the same mesh and views skip the UV pass")
+    parser.add_argument("--index-memory-mb", type=int, default=512,
+                        help="RAM of the view indexes kept by every worker, indexes saved in --index-dir are "
+                             "memory-mapped and do not count")
+    parser.add_argument("--index-disk-mb", type=int, default=2048,
+                        help="Size of --index-dir, the least recently used indexes are removed above it")
+    parser.add_argument("--session-dir",
+                        help="Directory of the memory-mapped buffers of large textures, the system temporary "
+                             "directory by default")
+    parser.add_argument("--snapshot-dir",
+                        help="Local directory with the pipeline weights. It is filled on the first start "
+                             "and used on the next ones")
+    args = parser.parse_args()
+    if args.backend == "stub":
+        backend_options = {"step_time": args.stub_step_time}
+    else:
+        backend_options = {"model_id": args.model, "dtype": args.dtype, "snapshot_dir": args.snapshot_dir,
+                           "prompt_cache_size": args.prompt_cache_size}
+    cache_options = None
+    if args.result_cache_size > 0 or args.result_cache_dir:
+        cache_options = {"memory_size": args.result_cache_size, "directory": args.result_cache_dir,
+                         "max_disk_mb": args.result_cache_disk_mb}
+    start_server(args.port, host=args.host, backend=args.backend, workers=args.workers,
+                 devices=args.device.split(","), cache_options=cache_options, index_dir=args.index_dir,
+                 index_memory_mb=args.index_memory_mb, index_disk_mb=args.index_disk_mb, session_dir=args.session_dir,
+                 **backend_options)